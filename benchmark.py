@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hot paths of mav, reporting wall time and query counts
+
+Usage: python benchmark.py [--attributes N] [--objects M] [--repeat R] [--json]
+
+The benchmarks run in a test database created from the settings in DJANGO_SETTINGS_MODULE (default
+testsettings, sqlite in memory). Point DJANGO_SETTINGS_MODULE to settings with a PostgreSQL database
+to benchmark PostgreSQL. The exit status is 1 if a benchmark uses more queries than expected.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import sys
+from timeit import default_timer
+
+
+# Transaction control statements are logged by some backends only, and are not counted
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT', )
+
+
+def measure(func, repeat):
+    """
+    Run func repeat times, return (best seconds, mean seconds, queries in the last run)
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = default_timer()
+            func()
+            timings.append(default_timer() - start)
+    queries = [q for q in context.captured_queries if not q['sql'].upper().startswith(TRANSACTION_STATEMENTS)]
+    return min(timings), sum(timings) / len(timings), len(queries)
+
+
+def create_data(attribute_count, object_count):
+    from mav.bulk import save_many_attribute_values
+    from mav.models import Attribute
+    from mav.tests import Foo
+
+    types = [attribute_type for attribute_type, name in Attribute.CHOICES_FOR_TYPE]
+    attributes = [
+        Attribute.objects.create(
+            slug='attribute_{}'.format(i),
+            name='attribute {}'.format(i),
+            type=types[i % len(types)],
+        )
+        for i in range(attribute_count)
+    ]
+    objects = [Foo.objects.create(name='foo {}'.format(i)) for i in range(object_count)]
+    save_many_attribute_values([
+        (obj, dict((attribute.pk, sample_text(attribute, i)) for attribute in attributes))
+        for i, obj in enumerate(objects)
+    ])
+    return attributes, objects
+
+
+def sample_text(attribute, i):
+    from mav.models import Attribute
+
+    return {
+        Attribute.TYPE_TEXT: 'text {}'.format(i),
+        Attribute.TYPE_BOOLEAN: 'TRUE' if i % 2 else 'FALSE',
+        Attribute.TYPE_INTEGER: '{}'.format(i),
+        Attribute.TYPE_DECIMAL: '{}.5'.format(i),
+        Attribute.TYPE_DATE: '2000-01-{:02d}'.format(i % 28 + 1),
+        Attribute.TYPE_TIME: '12:{:02d}:00'.format(i % 60),
+    }[attribute.type]
+
+
+def run_benchmarks(attribute_count, object_count, repeat):
+    from django import forms
+
+    from mav.converters import convert_many
+    from mav.forms import FIELD_PREFIX, ModelFormWithAttrs
+    from mav.metadata import metadata
+    from mav.tests import Foo
+
+    class FooForm(ModelFormWithAttrs):
+        class Meta:
+            model = Foo
+            fields = ['name']
+
+    attributes, objects = create_data(attribute_count, object_count)
+    metadata.get_index()
+    obj = objects[0]
+    results = []
+
+    def add(name, expected_queries, func, rows=None):
+        best, mean, queries = measure(func, repeat)
+        results.append({
+            'name': name,
+            'best_ms': best * 1000,
+            'mean_ms': mean * 1000,
+            'queries': queries,
+            'expected_queries': expected_queries,
+            'rows_per_second': rows / best if rows and best else None,
+        })
+
+    add('form construction ({} attributes)'.format(attribute_count), 1, lambda: FooForm(instance=obj))
+
+    counter = [0]
+
+    def save_form():
+        counter[0] += 1
+        data = {'name': obj.name}
+        for attribute in attributes:
+            data['{}{}'.format(FIELD_PREFIX, attribute.pk)] = sample_text(attribute, counter[0])
+        form = FooForm(instance=obj, data=data)
+        if not form.is_valid():
+            raise forms.ValidationError(form.errors)
+        form.save()
+
+    add('form save ({} changed attributes)'.format(attribute_count), 4, save_form)
+
+    text_count = 10000
+    for attribute in attributes[:6]:
+        texts = [sample_text(attribute, i) for i in range(text_count)]
+        add(
+            'convert {} ({} texts)'.format(attribute.get_type_display(), text_count),
+            0,
+            lambda: convert_many(attribute, texts),
+            rows=text_count,
+        )
+
+    slugs = [attribute.slug for attribute in attributes]
+    add(
+        'with_attr_values ({} objects, {} attributes)'.format(object_count, attribute_count),
+        1,
+        lambda: list(Foo.objects.with_attr_values(*slugs)),
+        rows=object_count,
+    )
+    add(
+        'attrs per object ({} objects, {} attributes)'.format(object_count, attribute_count),
+        object_count + 1,
+        lambda: [[attr.get_value_display() for attr in o.attrs.all()] for o in Foo.objects.all()],
+        rows=object_count,
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of mav.')
+    parser.add_argument('--attributes', type=int, default=60, help='The number of attributes.')
+    parser.add_argument('--objects', type=int, default=500, help='The number of objects.')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of runs per benchmark.')
+    parser.add_argument('--json', action='store_true', help='Output the results as JSON.')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testsettings')
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    # The benchmarks use the test models
+    import mav.tests  # NOQA
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run_benchmarks(args.attributes, args.objects, args.repeat)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    over_budget = [r for r in results if r['queries'] > r['expected_queries']]
+    if args.json:
+        print(json.dumps({'vendor': connection.vendor, 'results': results}, indent=2))
+    else:
+        print('{:<50} {:>10} {:>10} {:>8} {:>12}'.format('benchmark', 'best ms', 'mean ms', 'queries', 'rows/s'))
+        for r in results:
+            print('{:<50} {:>10.2f} {:>10.2f} {:>8} {:>12}{}'.format(
+                r['name'],
+                r['best_ms'],
+                r['mean_ms'],
+                r['queries'],
+                '{:.0f}'.format(r['rows_per_second']) if r['rows_per_second'] else '',
+                ' (expected {})'.format(r['expected_queries']) if r in over_budget else '',
+            ))
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
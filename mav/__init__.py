@@ -1,2 +1,3 @@
 __version__ = '0.1'
 
+default_app_config = 'mav.apps.MavConfig'
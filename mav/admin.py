@@ -2,8 +2,20 @@ from __future__ import unicode_literals
 
 from django import forms
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import FieldError, ValidationError
+from django.utils import six
+from django.utils.encoding import force_text
 
-from .models import Attribute, Choice, Unit
+from .bulk import normalize_text, value_to_text
+from .forms import generate_attribute_field
+from .metadata import metadata
+from .models import Attribute, AttributeSet, AttributeSetMembership, Choice, Unit, get_attr_class_for, get_attr_classes
+from .query import filter_attrs, get_attr_value_subquery, get_attribute, with_attr_values
+
+# Prefix of the admin_order_field of attribute columns, followed by the attribute pk
+ORDER_FIELD_PREFIX = 'mav_order_'
 
 
 try:
@@ -12,6 +24,219 @@ except ImportError:
     AdminClass = admin.ModelAdmin
 
 
+class AttributeSetMembershipInline(admin.TabularInline):
+    model = AttributeSetMembership
+    extra = 1
+
+
+class AttributeSetAdmin(AdminClass):
+    inlines = [AttributeSetMembershipInline]
+    prepopulated_fields = {'slug': ('name', )}
+
+
+class AttributeChoiceField(forms.ModelChoiceField):
+    """
+    Choice field for an attribute, with the choices and validation from the metadata instead of queries
+    """
+
+    def __init__(self, *args, **kwargs):
+        attribute_types = kwargs.pop('attribute_types', None)
+        super(AttributeChoiceField, self).__init__(*args, **kwargs)
+        attributes = sorted(metadata.get_index().attributes.values(), key=lambda attribute: attribute.get_label())
+        choices = [] if self.empty_label is None else [('', self.empty_label)]
+        self.choices = choices + [
+            (attribute.pk, attribute.get_label())
+            for attribute in attributes
+            if attribute_types is None or attribute.type in attribute_types
+        ]
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            attribute = metadata.get_attribute(int(value))
+        except (TypeError, ValueError):
+            attribute = None
+        if attribute is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return attribute
+
+
+class AttrInlineForm(forms.ModelForm):
+    """
+    Form for AttrInline, validating and normalizing the value like the field of its attribute on
+    ModelFormWithAttrs (see generate_attribute_field)
+    """
+
+    def clean(self):
+        cleaned_data = super(AttrInlineForm, self).clean()
+        attribute = cleaned_data.get('attribute')
+        text = cleaned_data.get('value')
+        if attribute is None or not text:
+            return cleaned_data
+        if attribute.type == Attribute.TYPE_BOOLEAN:
+            # Stored booleans are texts like yes or True, which the choices of the boolean field do not include
+            try:
+                attribute.text_to_value(text)
+            except ValueError as error:
+                self.add_error('value', force_text(error))
+            return cleaned_data
+        try:
+            value = generate_attribute_field(attribute).clean(text)
+        except ValidationError as error:
+            self.add_error('value', error)
+        else:
+            cleaned_data['value'] = normalize_text(attribute, value_to_text(value))
+        return cleaned_data
+
+
+class AttrInline(admin.TabularInline):
+    """
+    Inline for the attrs of a model with mav, use MavAdminMixin to add it to the admin of that model
+
+    The permissions for the inline are those of the attr class, e.g. mav.change_fooattr.
+    """
+    form = AttrInlineForm
+    fields = ('attribute', 'value', )
+    extra = 1
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name == 'attribute':
+            kwargs['form_class'] = AttributeChoiceField
+            attribute_types = [
+                attribute_type
+                for attribute_type, attr_class in self.parent_model._mav_classes_by_type.items()
+                if attr_class is self.model
+            ]
+            if attribute_types:
+                # Split storage, only offer the attributes that are stored in this attr class
+                kwargs['attribute_types'] = attribute_types
+        return super(AttrInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class AttributeListFilter(admin.SimpleListFilter):
+    """
+    List filter on the choices of an attribute, see attribute_list_filter
+    """
+    slug = None
+
+    def __init__(self, request, params, model, model_admin):
+        self.title = get_attribute(self.slug).get_label()
+        self.parameter_name = 'mav_{slug}'.format(slug=self.slug)
+        super(AttributeListFilter, self).__init__(request, params, model, model_admin)
+
+    def lookups(self, request, model_admin):
+        return [
+            (force_text(value), label)
+            for value, label in get_attribute(self.slug).get_choices()
+            if value != ''
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        try:
+            return filter_attrs(queryset, **{self.slug: self.value()})
+        except (ValueError, FieldError) as error:
+            # Invalid values in the URL are handled like those of other filters, see ChangeList.get_queryset
+            raise IncorrectLookupParameters(error)
+
+
+def attribute_list_filter(slug):
+    """
+    Create a list filter class for an attribute, e.g. list_filter = [attribute_list_filter('color')]
+    """
+    return type(str('AttributeListFilter_{slug}'.format(slug=slug)), (AttributeListFilter, ), {'slug': slug})
+
+
+class AttrChangeList(ChangeList):
+    """
+    ChangeList that orders attribute columns by their typed values, and selects the attribute values of the
+    result page only, see MavAdminMixin
+    """
+
+    def get_results(self, request):
+        super(AttrChangeList, self).get_results(request)
+        slugs = self.model_admin.mav_list_display
+        if slugs:
+            # Only the query for the page selects the values, counting the objects does not
+            self.result_list = with_attr_values(self.result_list, *slugs)
+
+    def get_ordering(self, request, queryset):
+        ordering = super(AttrChangeList, self).get_ordering(request, queryset)
+        return [self.get_attr_ordering(field) for field in ordering]
+
+    def get_attr_ordering(self, field):
+        """
+        Replace the admin_order_field of an attribute column with the typed value subquery of order_by_attr
+        """
+        if not isinstance(field, six.string_types) or not field.lstrip('-').startswith(ORDER_FIELD_PREFIX):
+            return field
+        attribute = metadata.get_attribute(int(field.lstrip('-')[len(ORDER_FIELD_PREFIX):]))
+        subquery = get_attr_value_subquery(get_attr_class_for(self.model, attribute), attribute)
+        return subquery.desc() if field.startswith('-') else subquery.asc()
+
+
+class MavAdminMixin(object):
+    """
+    Mixin for the ModelAdmin of a model with mav, adding an inline for the attrs, columns and list filters
+    for attributes
+
+    The values for the attribute columns in mav_list_display are selected with a subquery per attribute in
+    the query for the result page (see with_attr_values and AttrChangeList). Counting the objects and the
+    other admin views do not select them.
+    """
+
+    # Slugs of the attributes to show as columns in the changelist
+    mav_list_display = ()
+
+    # Slugs of the attributes with choices to filter the changelist on
+    mav_list_filter = ()
+
+    # The inline class to use for the attrs
+    mav_inline = AttrInline
+
+    def __init__(self, model, admin_site):
+        self.inlines = list(self.inlines) + [
+            type(str('{name}Inline'.format(name=attr_class.__name__)), (self.mav_inline, ), {'model': attr_class})
+            for attr_class in get_attr_classes(model)
+        ]
+        super(MavAdminMixin, self).__init__(model, admin_site)
+
+    def get_attr_column(self, slug):
+        """
+        Get a list_display column for an attribute, reading the attr_values set by AttrChangeList
+        """
+        attribute = get_attribute(slug)
+        is_boolean = attribute.type == Attribute.TYPE_BOOLEAN
+
+        def column(obj):
+            value = getattr(obj, 'attr_values', {}).get(slug)
+            if is_boolean:
+                return value
+            if value is None:
+                return self.get_empty_value_display()
+            return attribute.get_value_display(value)
+
+        column.__name__ = str('mav_{slug}'.format(slug=slug))
+        column.short_description = attribute.get_label()
+        column.admin_order_field = '{prefix}{pk}'.format(prefix=ORDER_FIELD_PREFIX, pk=attribute.pk)
+        column.boolean = is_boolean
+        return column
+
+    def get_changelist(self, request, **kwargs):
+        return AttrChangeList
+
+    def get_list_display(self, request):
+        list_display = super(MavAdminMixin, self).get_list_display(request)
+        return list(list_display) + [self.get_attr_column(slug) for slug in self.mav_list_display]
+
+    def get_list_filter(self, request):
+        list_filter = super(MavAdminMixin, self).get_list_filter(request)
+        return list(list_filter) + [attribute_list_filter(slug) for slug in self.mav_list_filter]
+
+
 admin.site.register(Attribute, AdminClass)
+admin.site.register(AttributeSet, AttributeSetAdmin)
 admin.site.register(Choice, AdminClass)
 admin.site.register(Unit, AdminClass)
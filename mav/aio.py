@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .bulk import save_attribute_values, save_many_attribute_values
+from .metadata import metadata
+from .query import attr_bags
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+def get_attr_values(instance, *slugs):
+    """
+    Get the typed values of the attributes of an instance in one query
+    :param instance: The model instance (of a model with mav)
+    :param slugs: The slugs of the attributes to get (default all)
+    :return: Dict of {slug: value}
+    """
+    # Load the metadata first, so it does not happen halfway
+    metadata.get_index()
+    queryset = type(instance)._default_manager.using(instance._state.db).filter(pk=instance.pk)
+    for bag in attr_bags(queryset, *slugs):
+        return bag.as_dict()
+    return {}
+
+
+def make_async(func):
+    """
+    Wrap a synchronous function in sync_to_async, so it runs in a single thread hop
+    """
+    if sync_to_async is None:
+        def unavailable(*args, **kwargs):
+            raise ImproperlyConfigured('The async functions of mav require asgiref.')
+        return unavailable
+    return sync_to_async(func)
+
+
+# Async counterparts of batched operations, use them as e.g. `values = await aget_attr_values(foo)`. Once
+# the metadata is loaded, get_value_display and get_choices need no queries and can be called directly.
+asave_attribute_values = make_async(save_attribute_values)
+asave_many_attribute_values = make_async(save_many_attribute_values)
+aget_attr_values = make_async(get_attr_values)
+aload_metadata = make_async(metadata.get_index)
@@ -0,0 +1,22 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils.translation import ugettext_lazy as _
+
+
+class MavConfig(AppConfig):
+    name = 'mav'
+    verbose_name = _('Model attribute values')
+
+    def ready(self):
+        from .metadata import invalidate_metadata
+        for model_name in ('Attribute', 'Choice', 'Unit', 'AttributeSet', 'AttributeSetMembership'):
+            model = self.get_model(model_name)
+            post_save.connect(invalidate_metadata, sender=model, dispatch_uid='mav.metadata.save.' + model_name)
+            post_delete.connect(invalidate_metadata, sender=model, dispatch_uid='mav.metadata.delete.' + model_name)
+        # Move the values of attributes that change type, with split storage
+        from .models import move_attrs_on_type_change, remember_attribute_type
+        attribute = self.get_model('Attribute')
+        pre_save.connect(remember_attribute_type, sender=attribute, dispatch_uid='mav.split.type')
+        post_save.connect(move_attrs_on_type_change, sender=attribute, dispatch_uid='mav.split.type')
@@ -0,0 +1,74 @@
+from __future__ import unicode_literals
+
+from .metadata import metadata
+
+
+class AttrBag(object):
+    """
+    The attribute values of a single object, as text by attribute id, converted to typed values on access by slug
+    """
+    __slots__ = ('object_id', 'texts', )
+
+    def __init__(self, object_id, texts):
+        self.object_id = object_id
+        # Dict of {attribute_id: text}
+        self.texts = texts
+
+    def _get_attribute_id(self, slug):
+        attribute = metadata.get_attribute_by_slug(slug)
+        if attribute is None:
+            return None
+        return attribute.pk
+
+    def get_text(self, slug, default=None):
+        """
+        Return the text of an attribute
+        """
+        return self.texts.get(self._get_attribute_id(slug), default)
+
+    def get(self, slug, default=None):
+        """
+        Return the typed value of an attribute, default if the object has no value, None if the value is invalid
+        """
+        attribute = metadata.get_attribute_by_slug(slug)
+        if attribute is None or attribute.pk not in self.texts:
+            return default
+        try:
+            return attribute.get_converter()(self.texts[attribute.pk])
+        except ValueError:
+            return None
+
+    def __getitem__(self, slug):
+        attribute_id = self._get_attribute_id(slug)
+        if attribute_id not in self.texts:
+            raise KeyError(slug)
+        return self.get(slug)
+
+    def __contains__(self, slug):
+        return self._get_attribute_id(slug) in self.texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """
+        Return the slugs of the attributes, skipping attributes that are not in the metadata
+        """
+        index = metadata.get_index()
+        return [index.attributes[pk].slug for pk in self.texts if pk in index.attributes]
+
+    def items(self):
+        return [(slug, self.get(slug)) for slug in self.keys()]
+
+    def as_dict(self):
+        """
+        Return a dict of {slug: value}
+        """
+        return dict(self.items())
+
+    def __repr__(self):
+        return '<AttrBag {object_id}: {count} values>'.format(object_id=self.object_id, count=len(self.texts))
+
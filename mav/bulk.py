@@ -0,0 +1,401 @@
+from __future__ import unicode_literals
+
+import csv
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Case, Q, Value, When
+from django.utils.encoding import force_text
+
+from .instrumentation import instrument
+from .metadata import metadata
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+# The number of times to retry saving attributes that another transaction created at the same time
+CONFLICT_RETRIES = 3
+
+
+def value_to_text(value):
+    """
+    Convert a Python value to the text that is stored in AbstractModelAttribute.value
+    :param value: The value to convert (None is stored as an empty string)
+    :return: The text to store
+    """
+    if value is None:
+        return ''
+    return force_text(value)
+
+
+def normalize_text(attribute, text):
+    """
+    Normalize the text of a date or time to ISO format, so texts compare correctly in queries
+    :param attribute: The attribute (None if it is not in the metadata)
+    :param text: The text to normalize, invalid texts are returned as is
+    :return: The text to store
+    """
+    from .models import Attribute
+
+    if attribute is None or attribute.type not in (Attribute.TYPE_DATE, Attribute.TYPE_TIME) or text == '':
+        return text
+    try:
+        return value_to_text(attribute.text_to_value(text))
+    except ValueError:
+        return text
+
+
+def bulk_update(objs, fields, using=None):
+    """
+    Update fields for a list of model instances using a single UPDATE ... CASE WHEN query per batch
+    :param objs: The model instances to update (all of the same model)
+    :param fields: The names of the fields to update
+    :param using: The database alias, default the database for writing the model
+    :return: The number of rows updated
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+    model = type(objs[0])
+    db = using or router.db_for_write(model, instance=objs[0])
+    fields = [model._meta.get_field(name) for name in fields]
+    batch_size = connections[db].ops.bulk_batch_size(['pk', 'pk'] + fields, objs)
+    updated = 0
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        kwargs = {}
+        for field in fields:
+            whens = [
+                When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                for obj in batch
+            ]
+            kwargs[field.attname] = Case(*whens, output_field=field)
+        updated += model._default_manager.using(db).filter(pk__in=[obj.pk for obj in batch]).update(**kwargs)
+    return updated
+
+
+def save_attribute_values(instance, values, using=None):
+    """
+    Save attribute values for a single instance
+    :param instance: The model instance (of a model with mav)
+    :param values: Dict of {attribute_id: value}
+    :param using: The database alias, default the database of the instance (see save_many_attribute_values)
+    :return: Tuple of (created, updated, deleted) counts, see save_attr_texts
+    """
+    return save_many_attribute_values([(instance, values)], using=using)
+
+
+def save_many_attribute_values(items, using=None):
+    """
+    Save attribute values for many instances of the same model in a constant number of queries
+
+    All existing attributes for the instances are loaded in one query, new attributes are inserted
+    with one bulk_create, changed attributes are updated with one bulk update, and unchanged
+    attributes are skipped. Everything happens in a single transaction.
+    :param items: Iterable of (instance, values) tuples, values being a dict of {attribute_id: value}
+    :param using: The database alias, default the database the router picks for writing the attrs of the first
+                  instance (the database the instance was loaded from, with the default router)
+    :return: Tuple of (created, updated, deleted) counts, see save_attr_texts
+    """
+    texts = {}
+    model = None
+    for instance, values in items:
+        if not values:
+            continue
+        if model is None:
+            model = type(instance)
+            if using is None:
+                using = router.db_for_write(model._mav_class, instance=instance)
+        for attribute_id, value in values.items():
+            texts[(instance.pk, int(attribute_id))] = value_to_text(value)
+    if not texts:
+        return 0, 0, 0
+    return save_model_attr_texts(model, texts, using=using)
+
+
+def save_model_attr_texts(model, texts, update=True, using=None):
+    """
+    Save texts to the attr table of a model, or to the table for each attribute type with split storage
+    :param model: The model with mav
+    :param texts: Dict of {(object_id, attribute_id): text}
+    :param update: Update existing attributes, if False existing attributes are left alone
+    :param using: The database alias, default the database for writing the attrs of the model
+    :return: Tuple of (created, updated, deleted) counts, see save_attr_texts
+    """
+    from .models import get_attr_class_for
+
+    if using is None:
+        using = router.db_for_write(model._mav_class)
+    if len(model._mav_classes) == 1:
+        return save_attr_texts(model._mav_class, texts, update=update, using=using)
+    index = metadata.get_index()
+    texts_by_class = {}
+    for (object_id, attribute_id), text in texts.items():
+        attribute = index.attributes.get(attribute_id)
+        attr_class = model._mav_class if attribute is None else get_attr_class_for(model, attribute)
+        texts_by_class.setdefault(attr_class, {})[(object_id, attribute_id)] = text
+    created = updated = deleted = 0
+    with transaction.atomic(using=using):
+        for attr_class, class_texts in texts_by_class.items():
+            class_created, class_updated, class_deleted = save_attr_texts(
+                attr_class, class_texts, update=update, using=using,
+            )
+            created += class_created
+            updated += class_updated
+            deleted += class_deleted
+    return created, updated, deleted
+
+
+def save_attr_texts(attr_class, texts, update=True, using=None):
+    """
+    Save texts to the attr table in a single transaction, see save_many_attribute_values
+
+    Dates and times are stored in ISO format, see normalize_text. If the attr class has prune_empty set, empty
+    texts are not stored, and existing attributes with an empty text are deleted with a single DELETE. If another
+    transaction creates some of the attributes at the same time, the existing attributes are read again and the
+    save is retried (up to CONFLICT_RETRIES times) before the IntegrityError is raised.
+    :param attr_class: The generated attr class (derived from AbstractModelAttribute)
+    :param texts: Dict of {(object_id, attribute_id): text}
+    :param update: Update existing attributes, if False existing attributes are left alone
+    :param using: The database alias, default the database for writing the attr class. The existing attributes
+                  are read from the same database, never from a replica.
+    :return: Tuple of (created, updated, deleted) counts, deleted being the attributes deleted for empty texts
+    """
+    if using is None:
+        using = router.db_for_write(attr_class)
+    index = metadata.get_index()
+    wanted = dict(
+        (key, normalize_text(index.attributes.get(key[1]), text)) for key, text in texts.items()
+    )
+    empty = {}
+    if attr_class.prune_empty:
+        for key, text in texts.items():
+            if text == '':
+                object_id, attribute_id = key
+                empty.setdefault(object_id, set()).add(attribute_id)
+                del wanted[key]
+    object_ids = set(object_id for object_id, attribute_id in wanted)
+    attribute_ids = set(attribute_id for object_id, attribute_id in wanted)
+    model = attr_class._meta.get_field('object').remote_field.model
+
+    with instrument('save_attrs', model, attribute_count=len(attribute_ids), using=using):
+        for attempt in range(CONFLICT_RETRIES + 1):
+            new = []
+            changed = []
+            deleted = 0
+            missing = dict(wanted)
+            try:
+                # A savepoint if the caller is in a transaction, so a conflict can be retried
+                with transaction.atomic(using=using):
+                    if missing:
+                        for attr in get_existing_attrs(attr_class, object_ids, attribute_ids, using):
+                            key = (attr.object_id, attr.attribute_id)
+                            if key not in missing:
+                                continue
+                            value = missing.pop(key)
+                            if update and attr.value != value:
+                                attr.value = value
+                                attr.set_typed_values()
+                                changed.append(attr)
+                        # Whatever is left in missing does not exist yet
+                        for (object_id, attribute_id), value in missing.items():
+                            attr = attr_class(object_id=object_id, attribute_id=attribute_id, value=value)
+                            attr.set_typed_values()
+                            new.append(attr)
+                        if new:
+                            attr_class.objects.using(using).bulk_create(new)
+                        bulk_update(changed, ['value'] + list(attr_class.typed_value_fields), using=using)
+                    if empty and update:
+                        deleted = delete_attrs(attr_class, empty, using=using)
+                    if attr_class.snapshot_class is not None and (new or changed or deleted):
+                        refresh = set(attr.object_id for attr in new + changed)
+                        if deleted:
+                            refresh.update(empty)
+                        attr_class.snapshot_class.refresh(refresh, using=using)
+            except IntegrityError:
+                # Another transaction created some of the attributes after they were read, read them again
+                if attempt == CONFLICT_RETRIES:
+                    raise
+            else:
+                break
+
+    return len(new), len(changed), deleted
+
+
+def get_existing_attrs(attr_class, object_ids, attribute_ids, using):
+    """
+    Read the existing attributes of objects, see save_attr_texts
+    """
+    return attr_class.objects.using(using).filter(object_id__in=object_ids, attribute_id__in=attribute_ids)
+
+
+def raw_delete(queryset):
+    """
+    Delete the rows of a queryset with a single DELETE query, without collecting objects or sending signals
+    Only use this for models that nothing relates to, like the attr classes. This is the one place that uses
+    the private QuerySet._raw_delete of Django.
+    :return: The number of rows deleted
+    """
+    return queryset._raw_delete(queryset.db)
+
+
+def delete_attrs(attr_class, attribute_ids_by_object, using=None):
+    """
+    Delete attributes with a single DELETE query, without sending signals
+    :param attr_class: The generated attr class (derived from AbstractModelAttribute)
+    :param attribute_ids_by_object: Dict of {object_id: attribute ids}
+    :param using: The database alias, default the database for writing the attr class
+    :return: The number of rows deleted
+    """
+    if using is None:
+        using = router.db_for_write(attr_class)
+    condition = Q()
+    for object_id, attribute_ids in attribute_ids_by_object.items():
+        condition |= Q(object_id=object_id, attribute_id__in=attribute_ids)
+    return raw_delete(attr_class.objects.using(using).filter(condition))
+
+
+class ImportResult(object):
+    """
+    The result of import_values
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.deleted = 0
+        self.rejected = []
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.rows / self.seconds
+
+    def reject(self, number, row, reason):
+        self.rejected.append((number, row, reason))
+
+
+def import_values(model, rows, chunk_size=DEFAULT_CHUNK_SIZE, update=True, using=None):
+    """
+    Import attribute values in chunks, validating and normalizing every value with the attribute converter
+
+    Values are stored as the text of the converted value, which can differ from the imported text: a boolean
+    'yes' is stored as 'True', a date '2000-1-5' as '2000-01-05' and a decimal '1.50' as '1.5'.
+    :param model: The model with mav
+    :param rows: Iterable of (object_id, attribute slug, text) tuples
+    :param chunk_size: The number of rows to save per transaction
+    :param update: Update existing attributes, if False existing attributes are left alone
+    :param using: The database alias, default the database for writing the attrs of the model
+    :return: ImportResult, with a (row number, row, reason) tuple for every rejected row
+    """
+    if using is None:
+        using = router.db_for_write(model._mav_class)
+    index = metadata.get_index()
+    converters = {}
+    result = ImportResult()
+    start = time.time()
+
+    def save_chunk(chunk):
+        object_ids = set(object_id for object_id, attribute_id in chunk)
+        found = set(model._default_manager.using(using).filter(pk__in=object_ids).values_list('pk', flat=True))
+        texts = {}
+        for (object_id, attribute_id), (number, row, text) in chunk.items():
+            if object_id in found:
+                texts[(object_id, attribute_id)] = text
+            else:
+                result.reject(number, row, 'Unknown object {object_id}.'.format(object_id=object_id))
+        if not texts:
+            return
+        try:
+            created, updated, deleted = save_model_attr_texts(model, texts, update=update, using=using)
+        except IntegrityError as e:
+            # Keep importing the other chunks
+            for key in texts:
+                number, row, text = chunk[key]
+                result.reject(number, row, force_text(e))
+            return
+        result.created += created
+        result.updated += updated
+        result.deleted += deleted
+
+    chunk = {}
+    for number, row in enumerate(rows, 1):
+        result.rows += 1
+        try:
+            object_id, slug, text = row
+            object_id = model._meta.pk.to_python(object_id)
+        except (TypeError, ValueError, ValidationError):
+            result.reject(number, row, 'Invalid row.')
+            continue
+        attribute = index.attributes_by_slug.get(slug)
+        if attribute is None:
+            result.reject(number, row, 'Unknown attribute {slug}.'.format(slug=slug))
+            continue
+        if attribute.pk not in converters:
+            converters[attribute.pk] = attribute.get_converter()
+        try:
+            # Store the converted value, so e.g. '2000-1-5' is stored as '2000-01-05'
+            text = value_to_text(converters[attribute.pk](value_to_text(text)))
+        except ValueError as e:
+            result.reject(number, row, force_text(e))
+            continue
+        # Later rows for the same object and attribute win
+        chunk[(object_id, attribute.pk)] = (number, row, text)
+        if len(chunk) >= chunk_size:
+            save_chunk(chunk)
+            chunk = {}
+    if chunk:
+        save_chunk(chunk)
+
+    result.seconds = time.time() - start
+    return result
+
+
+def read_csv(fileobj):
+    """
+    Read (object_id, attribute slug, text) rows from CSV
+
+    The CSV has either the columns object_id, attribute and value, or a column object_id and a column for
+    each attribute (as written by mav.export.write_csv). Empty cells in the second format are skipped.
+    """
+    reader = csv.reader(fileobj)
+    try:
+        header = [force_text(name) for name in next(reader)]
+    except StopIteration:
+        return
+    long_format = header == ['object_id', 'attribute', 'value']
+    for line in reader:
+        line = [force_text(cell) for cell in line]
+        if long_format:
+            yield tuple(line)
+            continue
+        values = dict(zip(header, line))
+        object_id = values.pop('object_id', None)
+        for slug in header[1:]:
+            if values.get(slug):
+                yield object_id, slug, values[slug]
+
+
+def read_jsonlines(fileobj):
+    """
+    Read (object_id, attribute slug, value) rows from JSON lines as written by mav.export.write_jsonlines
+    """
+    for line in fileobj:
+        line = force_text(line).strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        for slug, value in record.get('attrs', {}).items():
+            if value is not None:
+                yield record.get('object_id'), slug, value
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonlines,
+}
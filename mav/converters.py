@@ -0,0 +1,116 @@
+from __future__ import unicode_literals
+
+import datetime
+
+from django.utils.translation import ugettext_lazy as _
+
+from .instrumentation import instrument
+
+
+BOOLEAN_TRUE_TEXTS = ('TRUE', 'YES', 'T', 'Y', '1',)
+BOOLEAN_FALSE_TEXTS = ('FALSE', 'NO', 'F', 'N', '0',)
+BOOLEAN_NULL_TEXTS = ('NULL', '',)
+
+BOOLEAN_VALUES = dict(
+    [(text, True) for text in BOOLEAN_TRUE_TEXTS] +
+    [(text, False) for text in BOOLEAN_FALSE_TEXTS] +
+    [(text, None) for text in BOOLEAN_NULL_TEXTS]
+)
+
+# Converters by attribute type, see register_converter
+_converters = {}
+
+
+def text_to_text(text):
+    """
+    Any text is valid text
+    """
+    return text
+
+
+def text_to_int(text):
+    """
+    Convert text to integer
+    """
+    return int(text)
+
+
+def text_to_float(text):
+    """
+    Convert text to float
+    """
+    return float(text)
+
+
+def text_to_boolean(text):
+    """
+    Convert text to boolean
+    """
+    try:
+        return BOOLEAN_VALUES[text.strip().upper()]
+    except KeyError:
+        raise ValueError(_('Value "{value}" is not a valid boolean.').format(value=text))
+
+
+def text_to_date(text):
+    """
+    Convert text (year-month-day) to date
+    """
+    parts = text.split('-')
+    try:
+        return datetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
+    except IndexError:
+        raise ValueError(_('Value "{value}" is not a valid date.').format(value=text))
+
+
+def text_to_time(text):
+    """
+    Convert text (hours[:minutes[:seconds]]) to time
+    """
+    parts = text.split(':')
+    count = len(parts)
+    return datetime.time(
+        int(parts[0]),
+        int(parts[1]) if count > 1 else 0,
+        int(parts[2]) if count > 2 else 0,
+    )
+
+
+def register_converter(type, converter):
+    """
+    Register the function that converts text to a value for an attribute type
+    :param type: The attribute type (Attribute.TYPE_*)
+    :param converter: Function that takes text and returns a value, raising ValueError for invalid text
+    """
+    _converters[type] = converter
+
+
+def get_converter(type):
+    """
+    Get the converter for an attribute type
+    :param type: The attribute type (Attribute.TYPE_*)
+    :return: The converter function, or None if there is no converter for the type
+    """
+    return _converters.get(type)
+
+
+def convert_many(attribute, texts):
+    """
+    Convert texts to values for an attribute, without raising on invalid texts
+    :param attribute: The attribute
+    :param texts: Iterable of texts
+    :return: Tuple of (values, errors), values being a list with None for every invalid text, and errors
+             a dict of {index: ValueError}
+    """
+    converter = attribute.get_converter()
+    values = []
+    errors = {}
+    append = values.append
+    with instrument('convert', attribute_count=1):
+        for index, text in enumerate(texts):
+            try:
+                append(converter(text))
+            except ValueError as e:
+                append(None)
+                errors[index] = e
+    return values, errors
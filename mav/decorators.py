@@ -1,15 +1,17 @@
 from __future__ import unicode_literals, absolute_import
 
 from .models import add_mav_to
+from .query import install_manager
 
 
 def _mav(cls, *args, **kwargs):
     """
-    Add mav to a model class and return that model class
+    Add mav to a model class, install a MavManager and return that model class
     :param cls: The model class that needs mav
     :return: The model class
     """
     add_mav_to(cls, *args, **kwargs)
+    install_manager(cls)
     return cls
 
 
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router
+from django.utils.encoding import force_str
+
+from .bulk import value_to_text
+from .metadata import metadata
+from .models import get_attr_classes, iter_attr_rows
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def get_attributes(slugs=None):
+    """
+    Get attributes by slug from the metadata, or all attributes ordered by slug
+    """
+    index = metadata.get_index()
+    if slugs is None:
+        return sorted(index.attributes.values(), key=lambda attribute: attribute.slug)
+    try:
+        return [index.attributes_by_slug[slug] for slug in slugs]
+    except KeyError as e:
+        raise ValueError('Unknown attribute {slug}.'.format(slug=e.args[0]))
+
+
+def stream(model, attributes=None, queryset=None, chunk_size=DEFAULT_CHUNK_SIZE, using=None):
+    """
+    Generate one record per object with attributes, ordered by object id
+    :param model: The model with mav
+    :param attributes: Slugs of the attributes to export (default all)
+    :param queryset: Restrict the export to the objects in this queryset of the model
+    :param chunk_size: The number of objects to read per query
+    :param using: The database alias, default the database of the queryset, or the database for reading the attrs
+    :return: Generator of (object_id, {slug: value}) tuples, invalid values are None
+    """
+    converters = dict(
+        (attribute.pk, (attribute.slug, attribute.get_converter())) for attribute in get_attributes(attributes)
+    )
+    if using is None:
+        using = queryset.db if queryset is not None else router.db_for_read(model._mav_class)
+    querysets = []
+    for attr_class in get_attr_classes(model):
+        attrs = attr_class.objects.using(using)
+        if attributes is not None:
+            attrs = attrs.filter(attribute_id__in=list(converters))
+        if queryset is not None:
+            attrs = attrs.filter(object_id__in=queryset.values('pk'))
+        querysets.append(attrs)
+
+    # Read chunks of objects, keyed on the last object id, so memory use is bounded by chunk_size
+    last_object_id = None
+    while True:
+        chunk = set()
+        for attrs in querysets:
+            object_ids = attrs.order_by('object_id').values_list('object_id', flat=True).distinct()
+            if last_object_id is not None:
+                object_ids = object_ids.filter(object_id__gt=last_object_id)
+            chunk.update(object_ids[:chunk_size])
+        chunk = sorted(chunk)[:chunk_size]
+        if not chunk:
+            break
+        records = dict((object_id, {}) for object_id in chunk)
+        rows = iter_attr_rows([
+            attrs.filter(object_id__gte=chunk[0], object_id__lte=chunk[-1]) for attrs in querysets
+        ])
+        for object_id, attribute_id, text in rows:
+            try:
+                slug, converter = converters[attribute_id]
+            except KeyError:
+                # Attribute is not in the metadata (yet)
+                continue
+            try:
+                records[object_id][slug] = converter(text)
+            except ValueError:
+                records[object_id][slug] = None
+        for object_id in chunk:
+            yield object_id, records[object_id]
+        last_object_id = chunk[-1]
+
+
+def write_csv(model, fileobj, attributes=None, **kwargs):
+    """
+    Write objects with attributes as CSV, with a column for the object id and one for each attribute
+    """
+    slugs = [attribute.slug for attribute in get_attributes(attributes)]
+    writer = csv.writer(fileobj)
+    writer.writerow([force_str(name) for name in ['object_id'] + slugs])
+    for object_id, values in stream(model, attributes=attributes, **kwargs):
+        writer.writerow([object_id] + [force_str(value_to_text(values.get(slug))) for slug in slugs])
+
+
+def write_jsonlines(model, fileobj, attributes=None, **kwargs):
+    """
+    Write objects with attributes as JSON lines, one {"object_id": ..., "attrs": {...}} object per line
+    """
+    encoder = DjangoJSONEncoder()
+    for object_id, values in stream(model, attributes=attributes, **kwargs):
+        fileobj.write(encoder.encode({'object_id': object_id, 'attrs': values}) + '\n')
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonlines,
+}
@@ -0,0 +1,161 @@
+from __future__ import unicode_literals
+
+import bisect
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+from django.utils.encoding import force_bytes, force_text
+from django.utils.translation import ugettext_lazy as _
+
+from .metadata import metadata
+from .models import Attribute, get_attr_class_for
+from .query import get_attr_class, get_attribute, get_object_filter
+
+
+# Attribute types that can be bucketed into ranges
+BUCKET_TYPES = (Attribute.TYPE_INTEGER, Attribute.TYPE_DECIMAL, Attribute.TYPE_DATE, Attribute.TYPE_TIME, )
+
+BOOLEAN_LABELS = {
+    True: _('yes'),
+    False: _('no'),
+}
+
+
+def get_bucket_label(low, high):
+    if low is None:
+        return '< {high}'.format(high=high)
+    if high is None:
+        return '>= {low}'.format(low=low)
+    return '{low} - {high}'.format(low=low, high=high)
+
+
+def count_values(attribute, counts, boundaries=None):
+    """
+    Turn the counts per text of an attribute into facets
+    :param attribute: The attribute
+    :param counts: Dict of {text: count}
+    :param boundaries: Sorted list of bucket boundaries, to count values of numeric and date attributes per range
+    :return: List of (value, label, count) tuples, value being a choice pk, a typed value, or a (low, high) range
+    """
+    choice_index = metadata.get_choice_index(attribute.pk)
+    converter = attribute.get_converter()
+    if boundaries is not None and attribute.type not in BUCKET_TYPES:
+        raise ValueError('Attribute {slug} cannot be bucketed.'.format(slug=attribute.slug))
+    values = {}
+    for text, count in counts.items():
+        if choice_index:
+            try:
+                value = int(text)
+            except ValueError:
+                value = choice_index.get_pk(text)
+            if value is None:
+                continue
+        else:
+            try:
+                value = converter(text)
+            except ValueError:
+                continue
+            if value is None or value == '':
+                continue
+            if boundaries is not None:
+                position = bisect.bisect_right(boundaries, value)
+                value = (
+                    boundaries[position - 1] if position > 0 else None,
+                    boundaries[position] if position < len(boundaries) else None,
+                )
+        values[value] = values.get(value, 0) + count
+
+    if choice_index:
+        # In the order of the choices
+        return [
+            (pk, label, values[pk])
+            for pk, label in choice_index.choices if pk in values
+        ]
+    if boundaries is not None:
+        # In the order of the buckets
+        return [
+            (value, get_bucket_label(*value), values[value])
+            for value in sorted(values, key=lambda value: (value[0] is not None, value[0]))
+        ]
+    # Most common values first
+    if attribute.type == Attribute.TYPE_BOOLEAN:
+        get_label = BOOLEAN_LABELS.get
+    else:
+        get_label = attribute.get_value_display
+    return [
+        (value, get_label(value), count)
+        for value, count in sorted(values.items(), key=lambda item: (-item[1], force_text(item[0])))
+    ]
+
+
+def get_cache_key(queryset, slugs, buckets):
+    sql, params = queryset.values('pk').query.sql_with_params()
+    key = '{model}|{using}|{sql}|{params}|{slugs}|{buckets}|{version}'.format(
+        model=queryset.model._meta.label,
+        # Only a database picked with queryset.using(), so a replica router does not split the cache
+        using=queryset._db or '',
+        sql=sql,
+        params=repr(params),
+        slugs=','.join(slugs),
+        buckets=repr(sorted(buckets.items())),
+        version=repr(metadata.version),
+    )
+    return 'mav.facets.{hash}'.format(hash=hashlib.md5(force_bytes(key)).hexdigest())
+
+
+def facets(queryset, slugs, buckets=None, cache_timeout=None):
+    """
+    Count the objects in a queryset per value of attributes, e.g. facets(queryset, ['color', 'weight'])
+
+    The values are counted with a single GROUP BY query on the attr table (one per attribute type with split
+    storage) on the database of the queryset, restricted to the objects in the queryset. Choices are counted
+    per choice and labelled with their display, booleans per boolean value, and numeric and date attributes
+    per range if they are in buckets. Invalid and empty values are not counted.
+    :param queryset: A queryset of a model with mav
+    :param slugs: The slugs of the attributes to count
+    :param buckets: Dict of {slug: sorted list of range boundaries} for numeric and date attributes
+    :param cache_timeout: Cache the result for this many seconds in the cache MAV_FACETS_CACHE (default
+                          'default'), keyed by the SQL of the queryset, the slugs, the buckets and the
+                          metadata version. Changes to the attribute values are not seen until it expires.
+    :return: OrderedDict of {slug: list of (value, label, count) tuples}
+    """
+    get_attr_class(queryset)
+    slugs = list(slugs)
+    buckets = buckets or {}
+    attributes = [get_attribute(slug) for slug in slugs]
+
+    cache = None
+    if cache_timeout is not None:
+        cache = caches[getattr(settings, 'MAV_FACETS_CACHE', 'default')]
+        cache_key = get_cache_key(queryset, slugs, buckets)
+        result = cache.get(cache_key)
+        if result is not None:
+            return result
+
+    # Group the attributes by attr class, for split storage
+    attribute_ids_by_class = OrderedDict()
+    for attribute in attributes:
+        attr_class = get_attr_class_for(queryset.model, attribute)
+        attribute_ids_by_class.setdefault(attr_class, []).append(attribute.pk)
+
+    using = queryset.db
+    object_filter = get_object_filter(queryset)
+    counts = dict((attribute.pk, {}) for attribute in attributes)
+    for attr_class, attribute_ids in attribute_ids_by_class.items():
+        attrs = attr_class.objects.using(using).filter(attribute_id__in=attribute_ids)
+        if object_filter is not None:
+            attrs = attrs.filter(**object_filter)
+        rows = attrs.order_by().values_list('attribute_id', 'value').annotate(count=Count('pk'))
+        for attribute_id, text, count in rows:
+            counts[attribute_id][text] = count
+
+    result = OrderedDict(
+        (attribute.slug, count_values(attribute, counts[attribute.pk], buckets.get(attribute.slug)))
+        for attribute in attributes
+    )
+    if cache is not None:
+        cache.set(cache_key, result, cache_timeout)
+    return result
@@ -1,10 +1,19 @@
 from __future__ import unicode_literals
+import copy
+import itertools
+import threading
 from collections import OrderedDict
 
 from django import forms
+from django.db import router, transaction
 from django.template.defaultfilters import capfirst
+from django.utils import six
+from django.utils.translation import get_language
 
-from .models import Attribute, Choice, AbstractModelAttribute
+from .bulk import save_attribute_values, save_many_attribute_values
+from .instrumentation import instrument
+from .metadata import metadata
+from .models import Attribute, Choice, AbstractModelAttribute, get_attr_classes, get_attrs_related_name
 
 
 FIELD_PREFIX = '__mav__'
@@ -16,7 +25,7 @@ class RelaxedFloatField(forms.FloatField):
     """
 
     def clean(self, value):
-        value = unicode(value)
+        value = six.text_type(value)
         if ',' in value and not '.' in value:
             value = value.replace(',', '.')
         return super(RelaxedFloatField, self).clean(value)
@@ -47,16 +56,62 @@ def generate_attribute_field(attribute, value=''):
     return field
 
 
+def get_field_name(attribute):
+    """
+    Get the name of the form field for an attribute
+    """
+    return '{prefix}{id}'.format(prefix=FIELD_PREFIX, id=attribute.id)
+
+
 def add_attribute_field_to_form(form, attribute, value=''):
     """
     Add field for attribute to form
     """
-    field_name = '{prefix}{id}'.format(prefix=FIELD_PREFIX, id=attribute.id)
     field = generate_attribute_field(attribute, value)
-    form.fields[field_name] = field
+    form.fields[get_field_name(attribute)] = field
     return form
 
 
+class FieldSpecCache(object):
+    """
+    Prototype fields for attributes, to be deep-copied for every form (like Django's base_fields)
+
+    The cache holds a field per attribute id and language (labels and choices can be translated), so it never
+    holds more fields per language than there are attributes, however the attributes are combined on forms. It
+    is cleared when the metadata changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._fields = {}
+
+    def get_fields(self, attributes):
+        """
+        Get an OrderedDict of {field name: prototype field} for a list of attributes
+        """
+        version = metadata.version
+        language = get_language()
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._fields = {}
+            cached = self._fields
+        fields = OrderedDict()
+        for attribute in attributes:
+            field = cached.get((language, attribute.id))
+            if field is None:
+                field = generate_attribute_field(attribute)
+                with self._lock:
+                    if version == self._version:
+                        self._fields[(language, attribute.id)] = field
+            fields[get_field_name(attribute)] = field
+        return fields
+
+
+field_specs = FieldSpecCache()
+
+
 def add_attribute_fields_to_form(form, attributes, attrs):
     """
     Add fields for attributes to form
@@ -64,51 +119,54 @@ def add_attribute_fields_to_form(form, attributes, attrs):
     attributes = attributes to add (Attribute)
     attrs = existing attributes (AbstractModelAttribute)
     """
-    existing = OrderedDict()
-    # Find existing attributes
-    if attrs:
-        for attr in attrs:
-            attribute = attr.attribute
-            existing[attribute.id] = attr.value
-    # Add fields for the attributes
-    if attributes:
-        for attribute in attributes:
-            value = existing.pop(attribute.id, '')
-            add_attribute_field_to_form(form, attribute, value)
-    # See if we have attributes for unlisted attributes and add those too
-    for attribute_id in existing:
-        value = existing[attribute_id]
-        attribute = Attribute.objects.get(pk=attribute_id)
-        add_attribute_field_to_form(form, attribute, value)
+    model = getattr(getattr(form, '_meta', None), 'model', None)
+    with instrument('build_form', model) as record:
+        existing = OrderedDict()
+        # Find existing attributes
+        if attrs:
+            for attr in attrs:
+                existing[attr.attribute_id] = attr
+        fields = []
+        # Add fields for the attributes, once each
+        if attributes:
+            for attribute in OrderedDict((attribute.id, attribute) for attribute in attributes).values():
+                attr = existing.pop(attribute.id, None)
+                value = attr.value if attr else ''
+                fields.append((attribute, value))
+        # See if we have attributes for unlisted attributes and add those too
+        for attr in existing.values():
+            fields.append((attr.get_attribute(), attr.value))
+        # Copy the prototype fields and set the values
+        prototypes = field_specs.get_fields([attribute for attribute, value in fields])
+        for attribute, value in fields:
+            field_name = get_field_name(attribute)
+            field = copy.deepcopy(prototypes[field_name])
+            field.initial = value
+            form.fields[field_name] = field
+        if record is not None:
+            record['attribute_count'] = len(fields)
     # Return the form
     return form
 
 
-def save_attribute_fields(form):
+def get_attribute_values(form):
     """
-    Save the attribute fields of a form to attributes
+    Get the cleaned values of the attribute fields of a form as a dict of {attribute_id: value}
     """
-    instance = form.instance
-    attributes = {}
+    values = {}
     pos = len(FIELD_PREFIX)
     for k in form.cleaned_data:
         if k[0:pos] == FIELD_PREFIX:
             attribute_id = k[pos:]
-            attributes[attribute_id] = form.cleaned_data[k]
-    if attributes:
-        # Process all attributes
-        for attribute_id in attributes:
-            # We need content_type, see above
-            value, created = instance.attrs.get_or_create(
-                attribute_id=attribute_id,
-                object=instance,
-            )
-            # Set the value (don't allow None)
-            value.value = attributes[attribute_id]
-            if value.value is None:
-                value.value = ''
-            # And save the value
-            value.save()
+            values[attribute_id] = form.cleaned_data[k]
+    return values
+
+
+def save_attribute_fields(form):
+    """
+    Save the attribute fields of a form to attributes
+    """
+    return save_attribute_values(form.instance, get_attribute_values(form))
 
 
 class AttrsModelFormMixin(object):
@@ -116,6 +174,9 @@ class AttrsModelFormMixin(object):
     Mixin to handle attributes in a ModelForm
     """
 
+    # Set to False if the attribute fields are saved elsewhere (see BaseModelFormSetWithAttrs)
+    save_attrs = True
+
     def __init__(self, *args, **kwargs):
         # Create the form
         super(AttrsModelFormMixin, self).__init__(*args, **kwargs)
@@ -129,28 +190,46 @@ class AttrsModelFormMixin(object):
         try:
             return self.instance.get_attributes()
         except AttributeError:
-            return None
+            pass
+        # Use the attribute set of the instance, if any
+        attribute_set_id = getattr(self.instance, 'attribute_set_id', None)
+        if attribute_set_id is not None:
+            return metadata.get_schema(attribute_set_id).attributes
+        return None
 
     def get_attrs(self):
         """
-        Get existing attributes with values
+        Get existing attributes with values, using prefetched attributes if available
         """
         try:
-            return self.instance.attrs.all()
+            attr_classes = get_attr_classes(type(self.instance))
         except AttributeError:
             return None
+        prefetched = getattr(self.instance, '_prefetched_objects_cache', {})
+        attrs = []
+        for attr_class in attr_classes:
+            related_name = get_attrs_related_name(attr_class)
+            manager = getattr(self.instance, related_name)
+            if related_name in prefetched:
+                attrs.append(manager.all())
+            else:
+                attrs.append(manager.with_attributes())
+        if len(attrs) == 1:
+            return attrs[0]
+        return list(itertools.chain(*attrs))
 
     def save(self, commit=True):
         instance = super(AttrsModelFormMixin, self).save(commit=commit)
-        if commit:
-            save_attribute_fields(self)
-        else:
-            # Modify the save_m2m of the model
-            super_save_m2m = self.save_m2m
-            def save_m2m():
-                super_save_m2m()
+        if self.save_attrs:
+            if commit:
                 save_attribute_fields(self)
-            self.save_m2m = save_m2m
+            else:
+                # Modify the save_m2m of the model
+                super_save_m2m = self.save_m2m
+                def save_m2m():
+                    super_save_m2m()
+                    save_attribute_fields(self)
+                self.save_m2m = save_m2m
         return instance
 
 
@@ -158,4 +237,52 @@ class ModelFormWithAttrs(AttrsModelFormMixin, forms.ModelForm):
     """
     A ModelForm that also handles attributes and attributes
     """
-    pass
\ No newline at end of file
+    pass
+
+
+class BaseModelFormSetWithAttrs(forms.BaseModelFormSet):
+    """
+    A model formset for forms with attributes, that loads and saves the attributes of all forms at once
+    """
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = super(BaseModelFormSetWithAttrs, self).get_queryset()
+            self._queryset = queryset.prefetch_related(
+                *[get_attrs_related_name(attr_class) for attr_class in get_attr_classes(self.model)]
+            )
+        return self._queryset
+
+    def save_new(self, form, commit=True):
+        self._attrs_forms.append(form)
+        return super(BaseModelFormSetWithAttrs, self).save_new(form, commit=commit)
+
+    def save_existing(self, form, instance, commit=True):
+        self._attrs_forms.append(form)
+        return super(BaseModelFormSetWithAttrs, self).save_existing(form, instance, commit=commit)
+
+    def save(self, commit=True):
+        self._attrs_forms = []
+        for form in self.forms:
+            form.save_attrs = False
+        if not commit:
+            instances = super(BaseModelFormSetWithAttrs, self).save(commit=commit)
+            # Modify the save_m2m of the formset
+            super_save_m2m = self.save_m2m
+            def save_m2m():
+                super_save_m2m()
+                self.save_attribute_fields()
+            self.save_m2m = save_m2m
+            return instances
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            instances = super(BaseModelFormSetWithAttrs, self).save(commit=commit)
+            self.save_attribute_fields()
+        return instances
+
+    def save_attribute_fields(self):
+        """
+        Save the attribute fields of all saved forms with a single bulk upsert
+        """
+        return save_many_attribute_values(
+            (form.instance, get_attribute_values(form)) for form in self._attrs_forms
+        )
@@ -0,0 +1,273 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.dispatch import Signal
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # Django < 1.10
+    MiddlewareMixin = object
+
+
+logger = logging.getLogger('mav.instrumentation')
+
+# Sent after every instrumented operation, with sender the model (or None)
+operation_finished = Signal(providing_args=[
+    'operation', 'model', 'attribute_count', 'query_count', 'duration', 'nested',
+])
+
+_local = threading.local()
+
+
+def get_collectors():
+    """
+    Return the list of active collectors in this thread
+    """
+    try:
+        return _local.collectors
+    except AttributeError:
+        _local.collectors = []
+        return _local.collectors
+
+
+class CountingCursorWrapper(object):
+    """
+    Cursor wrapper that counts the queries it executes, see QueryCounter
+    """
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def callproc(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.callproc(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+
+class QueryCounter(object):
+    """
+    Count the queries executed on a connection, e.g. with counter: ...
+
+    While it is entered, the cursors the connection makes are wrapped in a CountingCursorWrapper. This is what
+    connection.execute_wrapper does in Django 2.0, it does not depend on the query log (which only holds the
+    last 9000 queries) and costs no memory per query. Nested blocks share the count.
+    """
+    cursor_factories = ('make_cursor', 'make_debug_cursor', )
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+        self.depth = 0
+        self.saved = {}
+
+    def __enter__(self):
+        if not self.depth:
+            for name in self.cursor_factories:
+                self.saved[name] = self.connection.__dict__.get(name)
+                setattr(self.connection, name, self.wrap(getattr(self.connection, name)))
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if not self.depth:
+            for name in self.cursor_factories:
+                if self.saved[name] is None:
+                    delattr(self.connection, name)
+                else:
+                    setattr(self.connection, name, self.saved[name])
+            self.saved = {}
+
+    def wrap(self, make_cursor):
+        def make_counting_cursor(cursor):
+            return CountingCursorWrapper(make_cursor(cursor), self)
+        return make_counting_cursor
+
+
+def get_query_counter(using):
+    """
+    Return the QueryCounter for a database in this thread (connections are per thread)
+    """
+    try:
+        counters = _local.query_counters
+    except AttributeError:
+        counters = _local.query_counters = {}
+    counter = counters.get(using)
+    if counter is None or counter.connection is not connections[using]:
+        counter = counters[using] = QueryCounter(connections[using])
+    return counter
+
+
+def is_enabled():
+    """
+    Return True if anyone listens to instrumented operations in this thread
+    """
+    return bool(get_collectors()) or operation_finished.has_listeners()
+
+
+@contextmanager
+def instrument(operation, model=None, attribute_count=None, using=None):
+    """
+    Measure an operation, e.g. with instrument('save_attrs', model, attribute_count=10) as record: ...
+
+    Yields a dict with the record to send, which can be updated inside the block (e.g. to set the
+    attribute_count once it is known). When no one listens (see is_enabled) this yields None and costs
+    next to nothing. Queries are counted on the database using (default the database for reading the model),
+    see QueryCounter.
+    """
+    if not is_enabled():
+        yield None
+        return
+    if using is None:
+        using = router.db_for_read(model) if model is not None else DEFAULT_DB_ALIAS
+    counter = get_query_counter(using)
+    depth = getattr(_local, 'depth', 0)
+    record = {
+        'operation': operation,
+        'model': model,
+        'attribute_count': attribute_count,
+        'query_count': None,
+        'duration': 0.0,
+        # Nested operations are part of an outer operation, and are not counted in the totals
+        'nested': depth > 0,
+    }
+    _local.depth = depth + 1
+    start = default_timer()
+    queries_before = counter.count
+    try:
+        with counter:
+            yield record
+    finally:
+        record['duration'] = default_timer() - start
+        record['query_count'] = counter.count - queries_before
+        _local.depth = depth
+        for collector in get_collectors():
+            collector.add(record)
+        operation_finished.send(sender=model, **record)
+
+
+class Collector(object):
+    """
+    Aggregate instrumented operations, see collect
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    @property
+    def query_count(self):
+        return sum(record['query_count'] or 0 for record in self.records if not record['nested'])
+
+    @property
+    def duration(self):
+        return sum(record['duration'] for record in self.records if not record['nested'])
+
+    def summary(self):
+        """
+        Return a dict of {operation: (count, query count, duration)}
+        """
+        summary = {}
+        for record in self.records:
+            count, query_count, duration = summary.get(record['operation'], (0, 0, 0.0))
+            summary[record['operation']] = (
+                count + 1,
+                query_count + (record['query_count'] or 0),
+                duration + record['duration'],
+            )
+        return summary
+
+
+@contextmanager
+def collect():
+    """
+    Collect the instrumented operations in this thread, e.g. with collect() as collector: ...
+    """
+    collector = Collector()
+    collectors = get_collectors()
+    collectors.append(collector)
+    try:
+        yield collector
+    finally:
+        collectors.remove(collector)
+
+
+def log_collector(collector, description):
+    """
+    Log the operations of a collector, as a warning if they exceed MAV_INSTRUMENTATION_MAX_QUERIES or
+    MAV_INSTRUMENTATION_MAX_DURATION (in seconds)
+    """
+    if not collector.records:
+        return
+    max_queries = getattr(settings, 'MAV_INSTRUMENTATION_MAX_QUERIES', None)
+    max_duration = getattr(settings, 'MAV_INSTRUMENTATION_MAX_DURATION', None)
+    exceeded = (
+        (max_queries is not None and collector.query_count > max_queries) or
+        (max_duration is not None and collector.duration > max_duration)
+    )
+    logger.log(
+        logging.WARNING if exceeded else logging.DEBUG,
+        'mav in %s: %d operations, %d queries, %.1f ms (%s)',
+        description,
+        len(collector.records),
+        collector.query_count,
+        collector.duration * 1000,
+        ', '.join(
+            '{operation} x{count}: {queries} queries, {ms:.1f} ms'.format(
+                operation=operation,
+                count=count,
+                queries=query_count,
+                ms=duration * 1000,
+            )
+            for operation, (count, query_count, duration) in sorted(collector.summary().items())
+        ),
+    )
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    Middleware that collects the instrumented mav operations of each request and logs them, see log_collector
+    """
+
+    def process_request(self, request):
+        request._mav_collect = collect()
+        request._mav_collector = request._mav_collect.__enter__()
+
+    def process_response(self, request, response):
+        collect = getattr(request, '_mav_collect', None)
+        if collect is not None:
+            collect.__exit__(None, None, None)
+            log_collector(request._mav_collector, '{method} {path}'.format(
+                method=request.method,
+                path=request.path,
+            ))
+            del request._mav_collect
+        return response
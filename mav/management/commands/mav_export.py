@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import six
+
+from ...export import DEFAULT_CHUNK_SIZE, WRITERS
+from ...models import AttributeSet
+from ...utils import get_mav_model
+
+
+def open_output(path):
+    """
+    Open a file to write CSV or JSON lines to
+    """
+    if six.PY2:
+        return open(path, 'wb')
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+class Command(BaseCommand):
+    help = 'Export objects with their attribute values as CSV or JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to export (app_label.ModelName).')
+        parser.add_argument('--format', choices=sorted(WRITERS), default='csv', help='The output format.')
+        parser.add_argument('--attributes', help='Comma separated slugs of the attributes to export.')
+        parser.add_argument('--attribute-set', help='Slug of the attribute set with the attributes to export.')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='The number of objects to read per query.')
+        parser.add_argument('--output', help='The file to write to (default stdout).')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to export from (default "default").')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_mav_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        attributes = options['attributes'].split(',') if options['attributes'] else None
+        if options['attribute_set']:
+            try:
+                attribute_set = AttributeSet.objects.using(options['database']).get(slug=options['attribute_set'])
+            except AttributeSet.DoesNotExist:
+                raise CommandError('Unknown attribute set {slug}.'.format(slug=options['attribute_set']))
+            attributes = attribute_set.get_schema().slugs
+        writer = WRITERS[options['format']]
+        output = open_output(options['output']) if options['output'] else self.stdout
+        try:
+            writer(model, output, attributes=attributes, chunk_size=options['chunk_size'], using=options['database'])
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import six
+
+from ...bulk import DEFAULT_CHUNK_SIZE, READERS, import_values
+from ...utils import get_mav_model
+
+
+def open_input(path):
+    """
+    Open a file to read CSV or JSON lines from
+    """
+    if six.PY2:
+        return open(path, 'rb')
+    return io.open(path, 'r', encoding='utf-8', newline='')
+
+
+class Command(BaseCommand):
+    help = (
+        'Import attribute values from CSV or JSON lines. Values are validated and stored in the canonical text '
+        'of their type, so the stored text can differ from the input: e.g. a boolean "yes" is stored as "True" '
+        'and a date "2000-1-5" as "2000-01-05".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to import into (app_label.ModelName).')
+        parser.add_argument('input', help='The file to read from.')
+        parser.add_argument('--format', choices=sorted(READERS), default='csv', help='The input format.')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='The number of rows to save per transaction.')
+        parser.add_argument('--no-update', action='store_false', dest='update', default=True,
+                            help='Leave existing attribute values alone.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to import into (default "default").')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_mav_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        reader = READERS[options['format']]
+        with open_input(options['input']) as fileobj:
+            result = import_values(
+                model,
+                reader(fileobj),
+                chunk_size=options['chunk_size'],
+                update=options['update'],
+                using=options['database'],
+            )
+        for number, row, reason in result.rejected:
+            self.stderr.write('Rejected row {number}: {reason}'.format(number=number, reason=reason))
+        self.stdout.write(
+            'Imported {rows} rows in {seconds:.2f}s ({rate:.0f} rows/s): '
+            '{created} created, {updated} updated, {deleted} deleted, {rejected} rejected.'.format(
+                rows=result.rows,
+                seconds=result.seconds,
+                rate=result.rows_per_second,
+                created=result.created,
+                updated=result.updated,
+                deleted=result.deleted,
+                rejected=len(result.rejected),
+            )
+        )
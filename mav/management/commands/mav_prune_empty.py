@@ -0,0 +1,50 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from ...bulk import raw_delete
+from ...models import get_attr_classes
+from ...utils import get_mav_model
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def prune_empty(model, chunk_size=DEFAULT_CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+    """
+    Delete the attributes with an empty value of a model, in chunks
+    :return: The number of attributes deleted
+    """
+    count = 0
+    for attr_class in get_attr_classes(model):
+        empty = attr_class.objects.using(using).filter(value='').order_by('pk')
+        while True:
+            with transaction.atomic(using=using):
+                chunk = list(empty.values_list('pk', 'object_id')[:chunk_size])
+                if not chunk:
+                    break
+                attrs = attr_class.objects.using(using).filter(pk__in=[pk for pk, object_id in chunk])
+                count += raw_delete(attrs)
+                if attr_class.snapshot_class is not None:
+                    attr_class.snapshot_class.refresh((object_id for pk, object_id in chunk), using=using)
+    return count
+
+
+class Command(BaseCommand):
+    help = 'Delete the attributes with an empty value of a model with mav.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to prune (app_label.ModelName).')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='The number of attributes to delete per transaction.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to prune (default "default").')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_mav_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        count = prune_empty(model, chunk_size=options['chunk_size'], using=options['database'])
+        self.stdout.write('Deleted {count} empty attributes.'.format(count=count))
@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ...utils import get_mav_model
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def rebuild_snapshots(model, chunk_size=DEFAULT_CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+    """
+    Rebuild the attribute snapshots of all objects of a model, in chunks ordered by object id
+    :return: The number of objects
+    """
+    snapshot_class = model._mav_class.snapshot_class
+    object_ids = model._default_manager.using(using).order_by('pk').values_list('pk', flat=True)
+    count = 0
+    last_object_id = None
+    while True:
+        chunk = object_ids
+        if last_object_id is not None:
+            chunk = chunk.filter(pk__gt=last_object_id)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        snapshot_class.refresh(chunk, using=using)
+        count += len(chunk)
+        last_object_id = chunk[-1]
+    return count
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the attribute snapshots of a model with mav snapshots.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to rebuild snapshots for (app_label.ModelName).')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='The number of objects to rebuild per transaction.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database to rebuild the snapshots in (default "default").')
+
+    def handle(self, *args, **options):
+        try:
+            model = get_mav_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if model._mav_class.snapshot_class is None:
+            raise CommandError('Model {label} does not have mav snapshots.'.format(label=options['model']))
+        count = rebuild_snapshots(model, chunk_size=options['chunk_size'], using=options['database'])
+        self.stdout.write('Rebuilt snapshots for {count} objects.'.format(count=count))
@@ -0,0 +1,189 @@
+from __future__ import unicode_literals
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
+from django.db import router, transaction
+
+from .bulk import delete_attrs, save_model_attr_texts, value_to_text
+from .metadata import metadata
+
+
+class AttrMapping(MutableMapping):
+    """
+    The attribute values of an instance as a mapping of {slug: value}, see add_mav_to
+
+    The attrs of the instance are loaded on first access, from prefetched attrs if available. Assignments and
+    deletions are kept until save() (or saving the instance) writes them in one batch.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        # Dict of {attribute_id: text}, None until loaded
+        self._texts = None
+        # Dict of {attribute_id: text}, text being None for deleted attributes
+        self._dirty = {}
+
+    def _get_texts(self):
+        if self._texts is None:
+            texts = {}
+            if self.instance.pk is not None:
+                prefetched = getattr(self.instance, '_prefetched_objects_cache', {})
+                for attr_class in type(self.instance)._mav_classes:
+                    related_name = attr_class._meta.get_field('object').remote_field.get_accessor_name()
+                    attrs = getattr(self.instance, related_name)
+                    if related_name in prefetched:
+                        texts.update((attr.attribute_id, attr.value) for attr in attrs.all())
+                    else:
+                        texts.update(attrs.values_list('attribute_id', 'value'))
+            self._texts = texts
+        return self._texts
+
+    def _get_attribute(self, slug):
+        attribute = metadata.get_attribute_by_slug(slug)
+        if attribute is None:
+            raise KeyError(slug)
+        return attribute
+
+    def get_text(self, slug):
+        """
+        Return the text of an attribute, None if the instance has no value
+        """
+        attribute = self._get_attribute(slug)
+        if attribute.pk in self._dirty:
+            return self._dirty[attribute.pk]
+        return self._get_texts().get(attribute.pk)
+
+    def __getitem__(self, slug):
+        attribute = self._get_attribute(slug)
+        text = self.get_text(slug)
+        if text is None:
+            raise KeyError(slug)
+        try:
+            return attribute.get_converter()(text)
+        except ValueError:
+            return None
+
+    def __setitem__(self, slug, value):
+        attribute = self._get_attribute(slug)
+        text = value_to_text(value)
+        if text != '':
+            # Raises ValueError for invalid values
+            attribute.text_to_value(text)
+        if self._get_texts().get(attribute.pk) == text:
+            self._dirty.pop(attribute.pk, None)
+        else:
+            self._dirty[attribute.pk] = text
+
+    def __delitem__(self, slug):
+        attribute = self._get_attribute(slug)
+        if self.get_text(slug) is None:
+            raise KeyError(slug)
+        if attribute.pk in self._get_texts():
+            self._dirty[attribute.pk] = None
+        else:
+            del self._dirty[attribute.pk]
+
+    def _get_attribute_ids(self):
+        attribute_ids = set(self._get_texts())
+        for attribute_id, text in self._dirty.items():
+            if text is None:
+                attribute_ids.discard(attribute_id)
+            else:
+                attribute_ids.add(attribute_id)
+        return attribute_ids
+
+    def __iter__(self):
+        index = metadata.get_index()
+        for attribute_id in self._get_attribute_ids():
+            # Skip attributes that are not in the metadata (yet)
+            if attribute_id in index.attributes:
+                yield index.attributes[attribute_id].slug
+
+    def __len__(self):
+        return sum(1 for slug in self)
+
+    def __repr__(self):
+        return '<AttrMapping {values!r}>'.format(values=dict(self))
+
+    @property
+    def is_dirty(self):
+        return bool(self._dirty)
+
+    def get_dirty(self):
+        """
+        Return the slugs of the attributes that have been changed since the last save
+        """
+        index = metadata.get_index()
+        return set(index.attributes[pk].slug for pk in self._dirty if pk in index.attributes)
+
+    def save(self, using=None):
+        """
+        Write the changed attributes in one batch, see save_model_attr_texts
+        :param using: The database alias, default the database the router picks for writing the attrs of the
+                      instance (the database the instance was loaded from, with the default router)
+        """
+        if not self._dirty:
+            return
+        from .models import get_attr_class_for
+
+        model = type(self.instance)
+        pk = self.instance.pk
+        if using is None:
+            using = router.db_for_write(model._mav_class, instance=self.instance)
+        index = metadata.get_index()
+        texts = {}
+        deleted = {}
+        for attribute_id, text in self._dirty.items():
+            if text is not None:
+                texts[(pk, attribute_id)] = text
+            elif attribute_id in index.attributes:
+                attr_class = get_attr_class_for(model, index.attributes[attribute_id])
+                deleted.setdefault(attr_class, set()).add(attribute_id)
+        with transaction.atomic(using=using):
+            if texts:
+                save_model_attr_texts(model, texts, using=using)
+            for attr_class, attribute_ids in deleted.items():
+                delete_attrs(attr_class, {pk: attribute_ids}, using=using)
+            snapshot_class = model._mav_class.snapshot_class
+            if deleted and snapshot_class is not None:
+                snapshot_class.refresh([pk], using=using)
+        texts = self._get_texts()
+        for attribute_id, text in self._dirty.items():
+            if text is None or (text == '' and model._mav_class.prune_empty):
+                texts.pop(attribute_id, None)
+            else:
+                texts[attribute_id] = text
+        self._dirty = {}
+
+    def clear_cache(self):
+        """
+        Forget the loaded and changed attributes, the next access loads them again
+        """
+        self._texts = None
+        self._dirty = {}
+
+
+class AttrMappingDescriptor(object):
+    """
+    Descriptor that gives every instance of a model with mav an AttrMapping
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        mapping = instance.__dict__.get('_mav_mapping')
+        if mapping is None:
+            mapping = instance.__dict__['_mav_mapping'] = AttrMapping(instance)
+        return mapping
+
+
+def save_attr_mapping(sender, instance, raw=False, using=None, **kwargs):
+    """
+    Signal handler to save the changed attributes of an instance when the instance is saved
+    """
+    mapping = instance.__dict__.get('_mav_mapping')
+    if mapping is not None and mapping.is_dirty and not raw:
+        mapping.save(using=using)
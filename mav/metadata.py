@@ -0,0 +1,327 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import router, transaction
+
+from .instrumentation import instrument
+
+
+VERSION_CACHE_KEY = 'mav.metadata.version'
+DATA_CACHE_KEY = 'mav.metadata.data.{version}'
+
+
+class ChoiceIndex(object):
+    """
+    Lookups for the choices of a single attribute
+
+    The displays are read from the choices when they are needed, so they follow the active language if the
+    names of the choices are translated (e.g. with django-modeltranslation).
+    """
+
+    def __init__(self, choices):
+        # Dict of {pk: choice}, in the order of the choices
+        self.choices_by_pk = OrderedDict((choice.pk, choice) for choice in choices)
+        self.pks_by_value = dict((choice.value, choice.pk) for choice in choices)
+
+    def __len__(self):
+        return len(self.choices_by_pk)
+
+    @property
+    def choices(self):
+        """
+        List of (pk, display) tuples, in the order of the choices
+        """
+        return [(pk, choice.get_value_display()) for pk, choice in self.choices_by_pk.items()]
+
+    def get_display(self, pk, default=None):
+        choice = self.choices_by_pk.get(pk)
+        if choice is None:
+            return default
+        return choice.get_value_display()
+
+    def get_pk(self, value, default=None):
+        return self.pks_by_value.get(value, default)
+
+
+EMPTY_CHOICE_INDEX = ChoiceIndex(())
+
+
+def build_choice_indexes(choices):
+    """
+    Build the choice indexes for many attributes at once
+    :param choices: Iterable of Choice instances, in the wanted order
+    :return: Dict of {attribute_id: ChoiceIndex}
+    """
+    choices_by_attribute = {}
+    for choice in choices:
+        choices_by_attribute.setdefault(choice.attribute_id, []).append(choice)
+    return dict(
+        (attribute_id, ChoiceIndex(attribute_choices))
+        for attribute_id, attribute_choices in choices_by_attribute.items()
+    )
+
+
+class MetadataIndex(object):
+    """
+    Indexes of all Attribute, Choice and Unit rows, built from lists of model instances
+    """
+
+    def __init__(self, attributes, choices, units):
+        self.attributes = {}
+        self.attributes_by_slug = {}
+        for attribute in attributes:
+            self.attributes[attribute.pk] = attribute
+            self.attributes_by_slug[attribute.slug] = attribute
+        self.units = dict((unit.pk, unit) for unit in units)
+        self.choices = {}
+        self.choices_by_attribute = {}
+        choices = sorted(choices, key=lambda c: (c.sort_order, c.name))
+        for choice in choices:
+            self.choices[choice.pk] = choice
+            self.choices_by_attribute.setdefault(choice.attribute_id, []).append(choice)
+        self.choice_indexes = build_choice_indexes(choices)
+
+    @classmethod
+    def load(cls, using=None):
+        """
+        Load all rows from the database
+        :param using: The database alias, default the database the router picks for writing attributes. All rows
+                      are read from the same database, so they are consistent. The index is reloaded right after
+                      changes, and kept until the next change, so it is not read from a replica that may lag.
+        """
+        from .models import Attribute, Choice, Unit
+        if using is None:
+            using = router.db_for_write(Attribute)
+        return cls(
+            attributes=list(Attribute.objects.using(using)),
+            choices=list(Choice.objects.using(using)),
+            units=list(Unit.objects.using(using)),
+        )
+
+    def __getstate__(self):
+        # Pickle the rows only, the indexes are rebuilt when unpickling
+        return {
+            'attributes': list(self.attributes.values()),
+            'choices': list(self.choices.values()),
+            'units': list(self.units.values()),
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class AttributeSchema(object):
+    """
+    The ordered attributes of an attribute set, with their choices and units
+    """
+
+    def __init__(self, attribute_set_id, attributes, index):
+        self.attribute_set_id = attribute_set_id
+        self.attributes = attributes
+        self.slugs = [attribute.slug for attribute in attributes]
+        self.choice_indexes = dict(
+            (attribute.pk, index.choice_indexes.get(attribute.pk, EMPTY_CHOICE_INDEX)) for attribute in attributes
+        )
+        self.units = dict((attribute.pk, index.units.get(attribute.unit_id)) for attribute in attributes)
+
+    @classmethod
+    def load(cls, attribute_set_id, index, using=None):
+        """
+        Load the attribute ids of a set from the database, the rest comes from the metadata index
+        :param using: The database alias, default the database the router picks for writing memberships (like
+                      MetadataIndex.load)
+        """
+        from .models import AttributeSetMembership
+        if using is None:
+            using = router.db_for_write(AttributeSetMembership)
+        attribute_ids = AttributeSetMembership.objects.using(using).filter(
+            attribute_set_id=attribute_set_id,
+        ).order_by('sort_order', 'pk').values_list('attribute_id', flat=True)
+        attributes = [index.attributes[pk] for pk in attribute_ids if pk in index.attributes]
+        return cls(attribute_set_id, attributes, index)
+
+
+class Metadata(object):
+    """
+    Per-process registry of attribute metadata (Attribute, Choice and Unit)
+
+    All rows are loaded once and kept in memory until a post_save or post_delete signal for one of the
+    models invalidates them. The signal also increments a version number in a cache, which every process
+    checks at most once per MAV_METADATA_CHECK_INTERVAL seconds, so all workers reload after a change in
+    any one of them. Set MAV_METADATA_CACHE to the alias of a cache to share the data as well as the version.
+
+    Without MAV_METADATA_CACHE the version is kept in the default cache, which only reaches other processes
+    if that cache is shared (e.g. memcached or redis, not the per-process LocMemCache). Changes made without
+    signals, like queryset updates, or in processes that do not share the cache are not seen by the other
+    processes. Set MAV_METADATA_MAX_AGE to a number of seconds to reload the data at least that often.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = None
+        self._schemas = {}
+        self._local_version = 0
+        self._shared_version = None
+        self._checked = 0
+        self._loaded = 0
+
+    @property
+    def cache(self):
+        """
+        The cache to share the data between processes, None to keep the data in this process only
+        """
+        alias = getattr(settings, 'MAV_METADATA_CACHE', None)
+        if alias:
+            return caches[alias]
+        return None
+
+    @property
+    def version_cache(self):
+        """
+        The cache to share the version between processes, the default cache unless MAV_METADATA_CACHE is set
+        """
+        return self.cache or caches[DEFAULT_CACHE_ALIAS]
+
+    @property
+    def version(self):
+        """
+        A value that changes every time the metadata changes
+        """
+        self._check_version()
+        return self._local_version, self._shared_version
+
+    def _get_shared_version(self, cache):
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(VERSION_CACHE_KEY, 1, None)
+            version = cache.get(VERSION_CACHE_KEY, 1)
+        return version
+
+    def _check_version(self):
+        """
+        Clear the local data if another process has changed the shared version, or if it is older than
+        MAV_METADATA_MAX_AGE seconds
+        """
+        now = time.time()
+        max_age = getattr(settings, 'MAV_METADATA_MAX_AGE', None)
+        if max_age is not None and self._index is not None and now - self._loaded > max_age:
+            self.clear()
+        interval = getattr(settings, 'MAV_METADATA_CHECK_INTERVAL', 1)
+        if self._shared_version is not None and now - self._checked < interval:
+            return
+        version = self._get_shared_version(self.version_cache)
+        with self._lock:
+            self._checked = now
+            if version != self._shared_version:
+                self._shared_version = version
+                self._index = None
+                self._schemas = {}
+                self._local_version += 1
+
+    def _load(self):
+        with instrument('load_metadata'):
+            return self._load_index()
+
+    def _load_index(self):
+        cache = self.cache
+        if cache is None:
+            return MetadataIndex.load()
+        key = DATA_CACHE_KEY.format(version=self._shared_version)
+        index = cache.get(key)
+        if index is None:
+            index = MetadataIndex.load()
+            cache.set(key, index, getattr(settings, 'MAV_METADATA_CACHE_TIMEOUT', None))
+        return index
+
+    def get_index(self):
+        """
+        Return the MetadataIndex, loading it if needed
+        """
+        self._check_version()
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index
+                if index is None:
+                    index = self._index = self._load()
+                    self._loaded = time.time()
+        return index
+
+    def clear(self):
+        """
+        Clear the data in this process
+        """
+        with self._lock:
+            self._index = None
+            self._schemas = {}
+            self._local_version += 1
+
+    def invalidate(self):
+        """
+        Clear the data in this process and tell other processes to do the same
+        """
+        self.clear()
+        cache = self.version_cache
+        try:
+            version = cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            cache.add(VERSION_CACHE_KEY, 1, None)
+            version = cache.get(VERSION_CACHE_KEY, 1)
+        with self._lock:
+            self._shared_version = version
+            self._checked = time.time()
+
+    def get_attribute(self, pk):
+        return self.get_index().attributes.get(pk)
+
+    def get_attribute_by_slug(self, slug):
+        return self.get_index().attributes_by_slug.get(slug)
+
+    def get_unit(self, pk):
+        return self.get_index().units.get(pk)
+
+    def get_choice(self, pk):
+        return self.get_index().choices.get(pk)
+
+    def get_choices(self, attribute_id):
+        """
+        Return the choices for an attribute, sorted by sort_order and name
+        """
+        return self.get_index().choices_by_attribute.get(attribute_id, [])
+
+    def get_choice_index(self, attribute_id):
+        """
+        Return the ChoiceIndex for an attribute (empty if the attribute has no choices)
+        """
+        return self.get_index().choice_indexes.get(attribute_id, EMPTY_CHOICE_INDEX)
+
+    def get_schema(self, attribute_set_id):
+        """
+        Return the AttributeSchema for an attribute set, loading it with a single query the first time
+        """
+        index = self.get_index()
+        schema = self._schemas.get(attribute_set_id)
+        if schema is None:
+            schema = AttributeSchema.load(attribute_set_id, index)
+            with self._lock:
+                if self._index is index:
+                    self._schemas[attribute_set_id] = schema
+        return schema
+
+
+metadata = Metadata()
+
+
+def invalidate_metadata(sender, **kwargs):
+    """
+    Signal handler to invalidate the metadata, again after the transaction commits
+    """
+    metadata.invalidate()
+    using = kwargs.get('using')
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(metadata.invalidate, using=using)
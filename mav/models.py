@@ -1,14 +1,28 @@
 from __future__ import unicode_literals
 
-import datetime
-
-from django.contrib.gis.db import models
-from django.core.exceptions import MultipleObjectsReturned
+import heapq
+import itertools
+import json
+import threading
+
+from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+from django.db.models import signals
+from django.utils import six
+from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
-from . import attrs
+from . import attrs, converters, registry
+from .bulk import bulk_update, normalize_text, raw_delete
+from .mapping import AttrMappingDescriptor, save_attr_mapping
+from .metadata import metadata
+
+# Per thread state of the snapshots that are refreshed after deletes, see refresh_snapshot_on_delete
+_local = threading.local()
 
 
+@python_2_unicode_compatible
 class Unit(models.Model):
     """
     A unit for a given attribute
@@ -16,10 +30,11 @@ class Unit(models.Model):
     name = models.CharField(_('name'), max_length=100, db_index=True)
     symbol = models.CharField(_('symbol'), max_length=10)
 
-    def __unicode__(self):
+    def __str__(self):
         return self.name
 
 
+@python_2_unicode_compatible
 class Attribute(models.Model):
     """
     An attribute for a model (the 'A' in EAV/OAV)
@@ -31,9 +46,9 @@ class Attribute(models.Model):
     TYPE_DATE = 5
     TYPE_TIME = 6
 
-    BOOLEAN_TRUE_TEXTS = ('TRUE', 'YES', 'T', 'Y', '1',)
-    BOOLEAN_FALSE_TEXTS = ('FALSE', 'NO', 'F', 'N', '0',)
-    BOOLEAN_NULL_TEXTS = ('NULL', '',)
+    BOOLEAN_TRUE_TEXTS = converters.BOOLEAN_TRUE_TEXTS
+    BOOLEAN_FALSE_TEXTS = converters.BOOLEAN_FALSE_TEXTS
+    BOOLEAN_NULL_TEXTS = converters.BOOLEAN_NULL_TEXTS
 
     CHOICES_FOR_TYPE = (
         (TYPE_TEXT, _('text')),
@@ -56,24 +71,26 @@ class Attribute(models.Model):
 
     def get_label(self):
         label = self.get_name_display()
-        if self.unit:
+        unit = metadata.get_unit(self.unit_id) if self.unit_id else None
+        if unit:
             label = '{label} ({symbol})'.format(
                 label=label,
-                symbol=self.unit.symbol,
+                symbol=unit.symbol,
             )
         return label
 
     def get_value_display(self, value):
         # If there are choices, try to get the choice representation
-        if self.choice_set.exists():
+        choice_index = metadata.get_choice_index(self.pk)
+        if choice_index:
             try:
-                choice = Choice.objects.get(pk=value)
-            except Choice.DoesNotExist:
-                pass
-            except MultipleObjectsReturned:
-                pass
-            else:
-                return choice.get_value_display()
+                pk = int(value)
+            except (TypeError, ValueError):
+                # Not a choice pk, maybe a choice value
+                pk = choice_index.get_pk(value)
+            display = choice_index.get_display(pk)
+            if display is not None:
+                return display
         # No choices or choices failed, just convert the value to string
         return '{}'.format(value)
 
@@ -91,89 +108,73 @@ class Attribute(models.Model):
                 ('FALSE', _('no')),
             )
 
-        return [(choice.pk, choice.get_value_display()) for choice in self.choice_set.order_by('sort_order', 'name')]
+        return list(metadata.get_choice_index(self.pk).choices)
 
     def text_to_int(self, text):
         """
         Convert text to integer
         """
-        return int(text)
+        return converters.text_to_int(text)
 
     def text_to_float(self, text):
         """
         Convert text to float
         """
-        return float(text)
+        return converters.text_to_float(text)
 
     def text_to_boolean(self, text):
         """
         Convert text to boolean
         """
-        if text in self.BOOLEAN_TRUE_TEXTS:
-            return True
-        if text in self.BOOLEAN_FALSE_TEXTS:
-            return False
-        if text in self.BOOLEAN_NULL_TEXTS:
-            return None
-        raise ValueError(_('Value "{value}" is not a valid boolean.').format(value=text))
+        return converters.text_to_boolean(text)
 
     def text_to_date(self, text):
         """
         Convert text to date
         """
-        parts = text.split('-')
-        return datetime.date(
-            int(parts[0].strip()),
-            int(parts[1].strip()),
-            int(parts[2].strip()),
-        )
+        return converters.text_to_date(text)
 
     def text_to_time(self, text):
         """
         Convert text to time
         """
-        parts = text.split(':')
-        hours = int(parts[0].strip())
-        try:
-            minutes = int(parts[1].strip())
-        except IndexError:
-            minutes = 0
-        try:
-            seconds = int(parts[2].strip())
-        except IndexError:
-            seconds = 0
-        return datetime.time(hours, minutes, seconds)
+        return converters.text_to_time(text)
+
+    def get_converter(self):
+        """
+        Get the function that converts text to a Python value for this attribute
+        """
+        converter = converters.get_converter(self.type)
+        if converter is None:
+            raise ValueError('Cannot convert text to value of type {type}.'.format(type=self.get_type_display()))
+        return converter
 
     def text_to_value(self, text):
         """
         Convert text to Python value
         """
-        # Any text is valid text
-        if self.type == self.TYPE_TEXT:
-            return text
-        # Copy, convert to uppercase and strip spaces
-        t = text.upper().strip()
-        # Try all other valid types
-        if self.type == self.TYPE_INTEGER:
-            return self.text_to_int(t)
-        if self.type == self.TYPE_DECIMAL:
-            return self.text_to_float(t)
-        if self.type == self.TYPE_BOOLEAN:
-            return self.text_to_boolean(t)
-        if self.type == self.TYPE_DATE:
-            return self.text_to_date(t)
-        if self.type == self.TYPE_TIME:
-            return self.text_to_time(t)
-        # We cannot parse this type, use original variable ``text`` for error
-        raise ValueError('Cannot convert text "{text}" to value of type {type}.'.format(
-            text=text,
-            type=self.get_type_display()
-        ))
-
-    def __unicode__(self):
+        converter = converters.get_converter(self.type)
+        if converter is None:
+            # We cannot parse this type
+            raise ValueError('Cannot convert text "{text}" to value of type {type}.'.format(
+                text=text,
+                type=self.get_type_display()
+            ))
+        return converter(text)
+
+    def __str__(self):
         return self.get_name_display()
 
 
+converters.register_converter(Attribute.TYPE_TEXT, converters.text_to_text)
+converters.register_converter(Attribute.TYPE_BOOLEAN, converters.text_to_boolean)
+converters.register_converter(Attribute.TYPE_INTEGER, converters.text_to_int)
+converters.register_converter(Attribute.TYPE_DECIMAL, converters.text_to_float)
+converters.register_converter(Attribute.TYPE_DATE, converters.text_to_date)
+converters.register_converter(Attribute.TYPE_TIME, converters.text_to_time)
+
+
+@python_2_unicode_compatible
 class Choice(models.Model):
     """
     A choice for the value of an attribute
@@ -189,13 +190,74 @@ class Choice(models.Model):
             return self.name
         return self.value
 
-    def __unicode__(self):
+    def __str__(self):
         return '{attribute}.{name}'.format(attribute=self.attribute.name, name=self.get_value_display())
 
     class Meta:
         ordering = ['attribute_id', 'sort_order', 'value', 'pk', ]
 
 
+@python_2_unicode_compatible
+class AttributeSet(models.Model):
+    """
+    An ordered set of attributes, e.g. the attributes for a category of objects
+    """
+    slug = models.SlugField(verbose_name=_('slug'), unique=True)
+    name = models.CharField(_('name'), max_length=100, db_index=True)
+    attributes = models.ManyToManyField(
+        Attribute,
+        verbose_name=_('attributes'),
+        through='AttributeSetMembership',
+        related_name='attribute_sets',
+        blank=True,
+    )
+
+    def get_schema(self):
+        """
+        Get the AttributeSchema for this set from the metadata
+        """
+        return metadata.get_schema(self.pk)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        ordering = ['name', 'pk', ]
+
+
+@python_2_unicode_compatible
+class AttributeSetMembership(models.Model):
+    """
+    An attribute in an attribute set
+    """
+    attribute_set = models.ForeignKey(AttributeSet, verbose_name=_('attribute set'))
+    attribute = models.ForeignKey(Attribute, verbose_name=_('attribute'))
+    sort_order = models.IntegerField(_('sort order'), default=0)
+
+    def __str__(self):
+        return '{attribute_set}.{attribute}'.format(
+            attribute_set=self.attribute_set.name,
+            attribute=self.attribute.get_name_display(),
+        )
+
+    class Meta:
+        ordering = ['attribute_set_id', 'sort_order', 'pk', ]
+        unique_together = [('attribute_set', 'attribute')]
+
+
+class ModelAttributeQuerySet(models.QuerySet):
+    """
+    QuerySet for classes derived from AbstractModelAttribute
+    """
+
+    def with_attributes(self):
+        """
+        Fetch the attributes and their units in the same query
+        """
+        return self.select_related('attribute__unit')
+
+
+@python_2_unicode_compatible
 class AbstractModelAttribute(models.Model):
     """
     Abstract model to store attribute/value for a model
@@ -203,21 +265,62 @@ class AbstractModelAttribute(models.Model):
     attribute = models.ForeignKey(Attribute)
     value = models.CharField(_('value'), max_length=100, blank=True)
 
+    # Names of fields derived from value, set by set_typed_values
+    typed_value_fields = ()
+
+    # The generated snapshot class (derived from AbstractModelAttributeSnapshot), if any
+    snapshot_class = None
+
+    # Delete attributes instead of saving empty values (in the bulk paths, see mav.bulk.save_attr_texts)
+    prune_empty = False
+
+    objects = ModelAttributeQuerySet.as_manager()
+
+    def get_attribute(self):
+        """
+        Return the attribute, from the metadata unless it has already been fetched
+        """
+        if not type(self).attribute.is_cached(self):
+            attribute = metadata.get_attribute(self.attribute_id)
+            if attribute is not None:
+                return attribute
+        return self.attribute
+
     def get_value(self):
         """
         Return the a Python variable of the appropriate type for the current value
         """
-        return self.attribute.text_to_value(self.value)
+        return self.get_attribute().text_to_value(self.value)
+
+    def set_typed_values(self):
+        """
+        Set the typed value fields from the current value (there are none in this class)
+        """
+        pass
+
+    def normalize_value(self):
+        """
+        Normalize the text of a date or time to ISO format, like mav.bulk.save_attribute_values does
+        """
+        self.value = normalize_text(metadata.get_attribute(self.attribute_id), self.value)
+
+    def clean(self):
+        super(AbstractModelAttribute, self).clean()
+        self.normalize_value()
+
+    def save(self, *args, **kwargs):
+        self.normalize_value()
+        super(AbstractModelAttribute, self).save(*args, **kwargs)
 
     def get_value_display(self):
         """
         Return a unicode representation of the current value
         """
-        return self.attribute.get_value_display(self.get_value())
+        return self.get_attribute().get_value_display(self.get_value())
 
-    def __unicode__(self):
+    def __str__(self):
         return '{attribute} = {value}'.format(
-            attribute=self.attribute,
+            attribute=self.get_attribute(),
             value=self.get_value_display(),
         )
 
@@ -225,12 +328,242 @@ class AbstractModelAttribute(models.Model):
         abstract = True
 
 
-def create_model_attribute_class(model, class_name=None, related_name=None, meta=None):
+class TypedValuesMixin(object):
+    """
+    Mixin for classes derived from AbstractModelAttribute that store a typed copy of the value for use in queries
+    """
+
+    # The typed value field for each attribute type
+    TYPED_VALUE_FIELDS = {
+        Attribute.TYPE_INTEGER: 'value_int',
+        Attribute.TYPE_DECIMAL: 'value_float',
+        Attribute.TYPE_BOOLEAN: 'value_bool',
+        Attribute.TYPE_DATE: 'value_date',
+        Attribute.TYPE_TIME: 'value_time',
+    }
+
+    typed_value_fields = ('value_int', 'value_float', 'value_bool', 'value_date', 'value_time', )
+
+    def set_typed_values(self):
+        """
+        Set the typed value fields from the current value, values that cannot be converted are stored as NULL
+        """
+        for field_name in self.typed_value_fields:
+            setattr(self, field_name, None)
+        field_name = self.TYPED_VALUE_FIELDS.get(self.get_attribute().type)
+        if field_name:
+            try:
+                setattr(self, field_name, self.get_value())
+            except ValueError:
+                pass
+
+    def save(self, *args, **kwargs):
+        self.set_typed_values()
+        super(TypedValuesMixin, self).save(*args, **kwargs)
+
+
+class AbstractTypedModelAttribute(TypedValuesMixin, AbstractModelAttribute):
+    """
+    Abstract model to store attribute/value for a model, with a typed copy of the value for use in queries
+    """
+    value_int = models.BigIntegerField(_('integer value'), null=True, blank=True, editable=False)
+    value_float = models.FloatField(_('decimal value'), null=True, blank=True, editable=False)
+    value_bool = models.NullBooleanField(_('boolean value'), editable=False)
+    value_date = models.DateField(_('date value'), null=True, blank=True, editable=False)
+    value_time = models.TimeField(_('time value'), null=True, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+
+class AbstractModelAttributeSnapshot(models.Model):
+    """
+    Abstract model to store the attribute values of an object as JSON, so they can be read without
+    querying the attr table
+    """
+    data = models.TextField(_('data'), default='{}', editable=False)
+
+    # The generated attr class (derived from AbstractModelAttribute) this is a snapshot of
+    attr_class = None
+
+    def get_values(self):
+        """
+        Return a dict of {slug: value} with typed values, None for invalid values
+        """
+        values = json.loads(self.data)
+        for slug, value in values.items():
+            if isinstance(value, six.string_types):
+                # Dates and times are stored as ISO text
+                attribute = metadata.get_attribute_by_slug(slug)
+                if attribute is not None and attribute.type in (Attribute.TYPE_DATE, Attribute.TYPE_TIME):
+                    try:
+                        values[slug] = attribute.text_to_value(value)
+                    except ValueError:
+                        values[slug] = None
+        return values
+
+    @classmethod
+    def refresh(cls, object_ids, create=True, using=None):
+        """
+        Rebuild the snapshots for objects from the attr table
+        :param object_ids: The ids of the objects
+        :param create: Create missing snapshots, if False only existing snapshots are updated
+        :param using: The database alias, default the database for writing snapshots. The attrs are read from
+                      the same database, so the snapshots are not built from a lagging replica.
+        """
+        object_ids = set(object_ids)
+        if not object_ids:
+            return
+        if using is None:
+            using = router.db_for_write(cls)
+        index = metadata.get_index()
+        attribute_converters = {}
+        values = dict((object_id, {}) for object_id in object_ids)
+        rows = []
+        for attr_class in get_attr_classes(cls._meta.get_field('object').remote_field.model):
+            attrs = attr_class.objects.using(using).filter(object_id__in=object_ids)
+            rows.extend(attrs.values_list('object_id', 'attribute_id', 'value'))
+        for object_id, attribute_id, text in rows:
+            attribute = index.attributes.get(attribute_id)
+            if attribute is None:
+                # Attribute is not in the metadata (yet)
+                continue
+            if attribute_id not in attribute_converters:
+                attribute_converters[attribute_id] = attribute.get_converter()
+            try:
+                values[object_id][attribute.slug] = attribute_converters[attribute_id](text)
+            except ValueError:
+                values[object_id][attribute.slug] = None
+
+        encoder = DjangoJSONEncoder(sort_keys=True)
+        with transaction.atomic(using=using):
+            existing = set(cls.objects.using(using).filter(pk__in=object_ids).values_list('pk', flat=True))
+            snapshots = [
+                cls(object_id=object_id, data=encoder.encode(object_values))
+                for object_id, object_values in values.items()
+            ]
+            bulk_update([snapshot for snapshot in snapshots if snapshot.object_id in existing], ['data'], using=using)
+            if create:
+                new = [snapshot for snapshot in snapshots if snapshot.object_id not in existing]
+                if new:
+                    cls.objects.using(using).bulk_create(new)
+
+    class Meta:
+        abstract = True
+
+
+def refresh_snapshot_on_save(sender, instance, raw=False, using=None, **kwargs):
+    """
+    Signal handler to refresh the snapshot of the object of a saved attr
+    """
+    if not raw:
+        sender.snapshot_class.refresh([instance.object_id], using=using)
+
+
+def get_deleting_objects():
+    """
+    Return the set of (model, pk, using) of the objects with snapshots that are being deleted in this thread
+    """
+    try:
+        return _local.deleting_objects
+    except AttributeError:
+        _local.deleting_objects = set()
+        return _local.deleting_objects
+
+
+def mark_deleting_object(sender, instance, using=None, **kwargs):
+    """
+    Signal handler to skip refreshing the snapshot for every attr of an object that is being deleted
+    """
+    get_deleting_objects().add((sender, instance.pk, using))
+
+
+def unmark_deleting_object(sender, instance, using=None, **kwargs):
+    """
+    Signal handler for objects that were deleted, see mark_deleting_object
+    """
+    get_deleting_objects().discard((sender, instance.pk, using))
+
+
+def get_pending_refreshes():
+    """
+    Return the dict of {(attr class, using): (attr pks, object ids)} of the attrs that are being deleted in this
+    thread, and the objects whose snapshots are refreshed when they have been deleted
+    """
+    try:
+        return _local.pending_refreshes
+    except AttributeError:
+        _local.pending_refreshes = {}
+        return _local.pending_refreshes
+
+
+def collect_snapshot_on_delete(sender, instance, using=None, **kwargs):
+    """
+    Signal handler to collect the object of an attr that is about to be deleted, see refresh_snapshot_on_delete
+    """
+    attr_pks, object_ids = get_pending_refreshes().setdefault((sender, using), (set(), set()))
+    attr_pks.add(instance.pk)
+    object_ids.add(instance.object_id)
+
+
+def refresh_snapshot_on_delete(sender, instance, using=None, **kwargs):
+    """
+    Signal handler to refresh the snapshots of the objects of deleted attrs
+
+    Django sends pre_delete for all the attrs it deletes together (a queryset, or the attrs of a deleted
+    attribute) before it deletes any of them, so the snapshots are refreshed once, after the last one.
+    """
+    pending = get_pending_refreshes()
+    attr_pks, object_ids = pending.get((sender, using), (set(), set([instance.object_id])))
+    attr_pks.discard(instance.pk)
+    if attr_pks:
+        return
+    pending.pop((sender, using), None)
+    model = sender._meta.get_field('object').remote_field.model
+    deleting = get_deleting_objects()
+    # The snapshots of objects that are being deleted are deleted with them
+    object_ids = [object_id for object_id in object_ids if (model, object_id, using) not in deleting]
+    # Do not create snapshots, the objects themselves may be being deleted
+    sender.snapshot_class.refresh(object_ids, create=False, using=using)
+
+
+def get_attr_snapshot(instance):
+    """
+    Get the attribute values of an object from its snapshot (see add_mav_to)
+    :param instance: The model instance (of a model with mav and snapshot)
+    :return: Dict of {slug: value}, empty if the object has no snapshot
+    """
+    snapshot_class = instance._mav_class.snapshot_class
+    related_name = snapshot_class._meta.get_field('object').remote_field.get_accessor_name()
+    try:
+        snapshot = getattr(instance, related_name)
+    except snapshot_class.DoesNotExist:
+        return {}
+    return snapshot.get_values()
+
+
+# Names of the attribute types, used for the classes and tables of split storage (see add_mav_to)
+SPLIT_TYPE_NAMES = {
+    Attribute.TYPE_TEXT: 'text',
+    Attribute.TYPE_BOOLEAN: 'boolean',
+    Attribute.TYPE_INTEGER: 'integer',
+    Attribute.TYPE_DECIMAL: 'decimal',
+    Attribute.TYPE_DATE: 'date',
+    Attribute.TYPE_TIME: 'time',
+}
+
+
+def create_model_attribute_class(model, class_name=None, related_name=None, meta=None, typed_values=False,
+                                 prune_empty=False, attribute_type=None):
     """
     Generate a value class (derived from AbstractModelAttribute) for a given model class
     :param model: The model to create a AbstractModelAttribute class for
     :param class_name: The name of the AbstractModelAttribute class to generate
     :param related_name: The related name
+    :param typed_values: Add indexed typed value columns (derive from AbstractTypedModelAttribute)
+    :param prune_empty: Delete attributes instead of saving empty values
+    :param attribute_type: Generate a class for the values of a single attribute type only, with an indexed
+                           typed value column for that type (typed_values is ignored)
     :return: A model derives from AbstractModelAttribute with an object pointing to model_class
     """
 
@@ -245,6 +578,18 @@ def create_model_attribute_class(model, class_name=None, related_name=None, meta
     # Force only one value for each model, attribute set
     meta['unique_together'] = list(meta.get('unique_together', [])) + [('attribute', 'object')]
 
+    # Index the typed values per attribute, for equality and range queries
+    typed_value_field_name = None
+    if attribute_type is not None:
+        typed_value_field_name = TypedValuesMixin.TYPED_VALUE_FIELDS.get(attribute_type)
+        meta['index_together'] = list(meta.get('index_together', [])) + [
+            ('attribute', typed_value_field_name or 'value')
+        ]
+    elif typed_values:
+        meta['index_together'] = list(meta.get('index_together', [])) + [
+            ('attribute', field_name) for field_name in AbstractTypedModelAttribute.typed_value_fields
+        ]
+
     # Use the same tablespace as the model
     meta['db_tablespace'] = model._meta.db_tablespace
 
@@ -266,18 +611,72 @@ def create_model_attribute_class(model, class_name=None, related_name=None, meta
     else:
         model_class_related_name = related_name
 
+    # The abstract class to derive from
+    if typed_value_field_name:
+        bases = (TypedValuesMixin, AbstractModelAttribute)
+    elif typed_values and attribute_type is None:
+        bases = (AbstractTypedModelAttribute,)
+    else:
+        bases = (AbstractModelAttribute,)
+
+    attributes = dict(
+        # Set to same module as model_class
+        __module__=model.__module__,
+        # Add a foreign key to model_class
+        object=models.ForeignKey(
+            model,
+            related_name=model_class_related_name
+        ),
+        prune_empty=prune_empty,
+        # Add Meta class
+        Meta=type(
+            str('Meta'),
+            (object,),
+            meta
+        ),
+    )
+
+    # Add the typed value field for a single attribute type
+    if typed_value_field_name:
+        field = AbstractTypedModelAttribute._meta.get_field(typed_value_field_name)
+        attributes[typed_value_field_name] = field.clone()
+        attributes['TYPED_VALUE_FIELDS'] = {attribute_type: typed_value_field_name}
+        attributes['typed_value_fields'] = (typed_value_field_name, )
+
     # Make a type for our class
-    value_class = type(
-        str(value_class_name),
-        (AbstractModelAttribute,),
+    value_class = type(str(value_class_name), bases, attributes)
+
+    return value_class
+
+
+def create_model_attribute_snapshot_class(model, attr_class, class_name=None, related_name=None):
+    """
+    Generate a snapshot class (derived from AbstractModelAttributeSnapshot) for a given model class
+    :param model: The model to create a snapshot class for
+    :param attr_class: The generated attr class of the model
+    :param class_name: The name of the class to generate
+    :param related_name: The related name
+    :return: A model derived from AbstractModelAttributeSnapshot with a one to one object pointing to model
+    """
+    meta = {
+        'db_tablespace': model._meta.db_tablespace,
+        'managed': model._meta.managed,
+        'db_table': '{0}_attr_snapshot'.format(model._meta.db_table),
+    }
+
+    return type(
+        str(class_name or '{name}Snapshot'.format(name=attr_class.__name__)),
+        (AbstractModelAttributeSnapshot,),
         dict(
             # Set to same module as model_class
             __module__=model.__module__,
-            # Add a foreign key to model_class
-            object=models.ForeignKey(
+            # The snapshot is stored in a side table with the object as primary key
+            object=models.OneToOneField(
                 model,
-                related_name=model_class_related_name
+                primary_key=True,
+                related_name=related_name or 'attrs_snapshot',
             ),
+            attr_class=attr_class,
             # Add Meta class
             Meta=type(
                 str('Meta'),
@@ -286,31 +685,275 @@ def create_model_attribute_class(model, class_name=None, related_name=None, meta
             ),
         ))
 
-    return value_class
+
+def get_attr_classes(model):
+    """
+    Get the generated attr classes of a model with mav (one per attribute type with split storage)
+    """
+    return model._mav_classes
 
 
-def add_mav_to(model, class_name=None, related_name=None, meta=None):
+def get_attrs_related_name(attr_class):
+    """
+    Get the name of the related manager for the attrs of an attr class on the model, e.g. 'attrs'
+    """
+    return attr_class._meta.get_field('object').remote_field.get_accessor_name()
+
+
+def get_attr_class_for(model, attribute):
+    """
+    Get the generated attr class of a model with mav that stores the values of an attribute
+    """
+    return model._mav_classes_by_type.get(attribute.type, model._mav_class)
+
+
+def get_split_models():
+    """
+    Get the models with split storage (see add_mav_to)
+    """
+    return [model for model in registry.get_mav_models() if model._mav_classes_by_type]
+
+
+class SplitAttrs(object):
+    """
+    The attrs of an object with split storage, spanning the related managers of all its attr classes
+
+    This is what obj.attrs returns for models with split storage, e.g. obj.attrs.get(attribute=weight). As the
+    attrs come from several tables, the methods return lists instead of querysets.
+    """
+
+    def __init__(self, instance, attr_classes):
+        self.instance = instance
+        self.managers = [getattr(instance, get_attrs_related_name(attr_class)) for attr_class in attr_classes]
+
+    def _combine(self, method, *args, **kwargs):
+        return list(itertools.chain.from_iterable(
+            getattr(manager, method)(*args, **kwargs) for manager in self.managers
+        ))
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        return self._combine('all')
+
+    def with_attributes(self):
+        return self._combine('with_attributes')
+
+    def filter(self, *args, **kwargs):
+        return self._combine('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._combine('exclude', *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        """
+        Get a single attr
+        :raises ObjectDoesNotExist, MultipleObjectsReturned: Like QuerySet.get, but not specific to an attr class
+        """
+        attrs = self.filter(*args, **kwargs)
+        if len(attrs) == 1:
+            return attrs[0]
+        if not attrs:
+            raise ObjectDoesNotExist('Attr matching query does not exist.')
+        raise MultipleObjectsReturned('get() returned more than one attr -- it returned {count}!'.format(
+            count=len(attrs),
+        ))
+
+    def exists(self):
+        return any(manager.exists() for manager in self.managers)
+
+    def count(self):
+        return sum(manager.count() for manager in self.managers)
+
+    def delete(self):
+        for manager in self.managers:
+            manager.all().delete()
+
+
+class SplitAttrsDescriptor(object):
+    """
+    Descriptor for obj.attrs on models with split storage, see SplitAttrs
+    """
+
+    def __init__(self, attr_classes):
+        self.attr_classes = attr_classes
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return SplitAttrs(instance, self.attr_classes)
+
+
+def remember_attribute_type(sender, instance, raw=False, using=None, **kwargs):
+    """
+    Signal handler to remember the stored type of an attribute before it is saved, see move_attrs_on_type_change
+    """
+    instance._mav_stored_type = None
+    if not raw and instance.pk is not None and get_split_models():
+        instance._mav_stored_type = sender._default_manager.using(using).filter(
+            pk=instance.pk,
+        ).values_list('type', flat=True).first()
+
+
+def move_attrs_on_type_change(sender, instance, raw=False, using=None, **kwargs):
+    """
+    Signal handler to move the values of an attribute to the tables for its new type, for models with split storage
+    """
+    stored_type = getattr(instance, '_mav_stored_type', None)
+    if raw or stored_type is None or stored_type == instance.type:
+        return
+    for model in get_split_models():
+        move_attrs(model, instance, stored_type, using=using)
+
+
+def move_attrs(model, attribute, stored_type, using=None):
+    """
+    Move the values of an attribute from the attr class for its stored type to the one for its current type
+    :param model: The model with split storage
+    :param attribute: The attribute, with its new type
+    :param stored_type: The type of the attribute the values are stored for
+    :param using: The database alias
+    :return: The number of values moved
+    """
+    source = model._mav_classes_by_type.get(stored_type, model._mav_class)
+    target = get_attr_class_for(model, attribute)
+    if source is target:
+        return 0
+    attrs = source.objects.using(using).filter(attribute_id=attribute.pk)
+    moved = []
+    for attr in attrs:
+        attr = target(object_id=attr.object_id, attribute=attribute, value=attr.value)
+        attr.set_typed_values()
+        moved.append(attr)
+    with transaction.atomic(using=using):
+        target.objects.using(using).bulk_create(moved)
+        raw_delete(attrs)
+    return len(moved)
+
+
+def iter_attr_rows(querysets):
+    """
+    Stream the (object_id, attribute_id, value) rows of querysets of attr classes, ordered by object id
+    :param querysets: Querysets of the attr classes of a model, see get_attr_classes
+    """
+    iterators = [
+        queryset.order_by('object_id').values_list('object_id', 'attribute_id', 'value').iterator()
+        for queryset in querysets
+    ]
+    if len(iterators) == 1:
+        return iterators[0]
+    return heapq.merge(*iterators)
+
+
+def add_mav_to(model, class_name=None, related_name=None, meta=None, typed_values=False, snapshot=False,
+               prune_empty=False, split_by_type=False):
     """
     Patch model class to have mav attributes
     :param model: The model class to patch
     :param class_name: The name of the class to generate
     :param related_name: The related_name to set in the model
-    :return: The generated class
+    :param typed_values: Add indexed typed value columns to the generated class
+    :param snapshot: Keep a JSON snapshot of the attribute values of every object, see get_attr_snapshot
+    :param prune_empty: Delete attributes instead of saving empty values
+    :param split_by_type: Generate a class (and table) for each attribute type, with a typed value column,
+                          e.g. FooAttrInteger in table foo_attr_integer with related name attrs_integer. The
+                          related name itself (attrs) spans all the classes, see SplitAttrs. Changing the type of
+                          an attribute moves its values, see move_attrs.
+    :return: The generated class (the class for text attributes with split storage)
     """
 
-    # Generate the class
-    mav_class = create_model_attribute_class(
-        model=model,
-        class_name=class_name,
-        related_name=related_name,
-        meta=meta,
-    )
+    if split_by_type:
+        # Generate a class for each attribute type
+        base_name = class_name or '{name}Attr'.format(name=model.__name__)
+        classes_by_type = {}
+        for attribute_type, type_name in sorted(SPLIT_TYPE_NAMES.items()):
+            type_meta = dict(meta or {})
+            type_meta['db_table'] = '{0}_{1}'.format(
+                type_meta.get('db_table', '{0}_attr'.format(model._meta.db_table)),
+                type_name,
+            )
+            classes_by_type[attribute_type] = create_model_attribute_class(
+                model=model,
+                class_name='{0}{1}'.format(base_name, type_name.capitalize()),
+                related_name='{0}_{1}'.format(related_name or 'attrs', type_name),
+                meta=type_meta,
+                prune_empty=prune_empty,
+                attribute_type=attribute_type,
+            )
+        # Attributes of unknown types are stored as text
+        mav_class = classes_by_type[Attribute.TYPE_TEXT]
+        mav_classes = [classes_by_type[attribute_type] for attribute_type in sorted(classes_by_type)]
+    else:
+        # Generate the class
+        mav_class = create_model_attribute_class(
+            model=model,
+            class_name=class_name,
+            related_name=related_name,
+            meta=meta,
+            typed_values=typed_values,
+            prune_empty=prune_empty,
+        )
+        classes_by_type = {}
+        mav_classes = [mav_class]
 
-    # Add it to .attrs
-    setattr(attrs, mav_class.__name__, mav_class)
+    # Add them to .attrs, for code that imports them from there (use mav.registry instead)
+    for attr_class in mav_classes:
+        setattr(attrs, attr_class.__name__, attr_class)
 
-    # Link it to the model
+    # Link them to the model
     model._mav_class = mav_class
+    model._mav_classes = tuple(mav_classes)
+    model._mav_classes_by_type = classes_by_type
+    if split_by_type:
+        setattr(model, related_name or 'attrs', SplitAttrsDescriptor(model._mav_classes))
+    registry.register(model, mav_class)
+
+    # Add the obj.mav mapping, and save its changes when the object is saved
+    if not hasattr(model, 'mav'):
+        model.mav = AttrMappingDescriptor()
+    signals.post_save.connect(
+        save_attr_mapping,
+        sender=model,
+        dispatch_uid='mav.mapping.save.{0}'.format(model._meta.label),
+    )
+
+    if snapshot:
+        snapshot_class = create_model_attribute_snapshot_class(
+            model=model,
+            attr_class=mav_class,
+            class_name='{0}Snapshot'.format(class_name or '{name}Attr'.format(name=model.__name__)),
+            related_name='{0}_snapshot'.format(related_name) if related_name else None,
+        )
+        setattr(attrs, snapshot_class.__name__, snapshot_class)
+        signals.pre_delete.connect(
+            mark_deleting_object,
+            sender=model,
+            dispatch_uid='mav.snapshot.mark_deleting.{0}'.format(model._meta.label),
+        )
+        signals.post_delete.connect(
+            unmark_deleting_object,
+            sender=model,
+            dispatch_uid='mav.snapshot.unmark_deleting.{0}'.format(model._meta.label),
+        )
+        for attr_class in mav_classes:
+            attr_class.snapshot_class = snapshot_class
+            # Single attrs saved through the ORM, the bulk paths refresh the snapshots themselves
+            signals.post_save.connect(
+                refresh_snapshot_on_save,
+                sender=attr_class,
+                dispatch_uid='mav.snapshot.save.{0}'.format(attr_class._meta.label),
+            )
+            signals.pre_delete.connect(
+                collect_snapshot_on_delete,
+                sender=attr_class,
+                dispatch_uid='mav.snapshot.collect.{0}'.format(attr_class._meta.label),
+            )
+            signals.post_delete.connect(
+                refresh_snapshot_on_delete,
+                sender=attr_class,
+                dispatch_uid='mav.snapshot.delete.{0}'.format(attr_class._meta.label),
+            )
 
     # Return the generated class
     return mav_class
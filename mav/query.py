@@ -0,0 +1,357 @@
+from __future__ import unicode_literals
+
+from itertools import groupby
+
+from django.core.exceptions import FieldError
+from django.db import models
+from django.db.models import Case, OuterRef, Q, Subquery, Value, When
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Cast
+from django.db.models.query import ModelIterable
+from django.utils import six
+
+from . import registry
+from .bags import AttrBag
+from .instrumentation import instrument
+from .metadata import metadata
+from .models import Attribute, get_attr_class_for, get_attr_classes, get_attrs_related_name, iter_attr_rows
+
+
+# Database field to cast text values to, for attribute types that have no typed value field
+CAST_FIELDS = {
+    Attribute.TYPE_INTEGER: models.BigIntegerField,
+    Attribute.TYPE_DECIMAL: models.FloatField,
+}
+
+# Patterns of the texts that can be cast, or compared as text for dates and times in ISO format (as stored by
+# mav.bulk.save_attr_texts). Other texts are invalid, and are treated as NULL in queries.
+VALID_TEXT_PATTERNS = {
+    Attribute.TYPE_INTEGER: r'^ *[-+]?[0-9]+ *$',
+    Attribute.TYPE_DECIMAL: r'^ *[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)? *$',
+    Attribute.TYPE_DATE: r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$',
+    Attribute.TYPE_TIME: r'^[0-9]{2}:[0-9]{2}:[0-9]{2}$',
+}
+
+# Lookups that take an iterable of values
+MULTIPLE_VALUE_LOOKUPS = ('in', 'range', )
+
+
+def get_attribute(slug):
+    """
+    Get an attribute by slug from the metadata
+    """
+    attribute = metadata.get_attribute_by_slug(slug)
+    if attribute is None:
+        raise FieldError("Cannot resolve attribute '{slug}'.".format(slug=slug))
+    return attribute
+
+
+def get_attr_class(queryset, attribute=None):
+    """
+    Get the generated attr class of the model of a queryset, or the one that stores an attribute
+    """
+    if not registry.is_registered(queryset.model):
+        raise TypeError("Model {name} does not have mav.".format(name=queryset.model.__name__))
+    if attribute is None:
+        return queryset.model._mav_class
+    return get_attr_class_for(queryset.model, attribute)
+
+
+def get_value_expression(attr_class, attribute):
+    """
+    Get the expression to use in queries for the value of an attribute
+    :return: Tuple of (expression, output field)
+    """
+    typed_fields = getattr(attr_class, 'TYPED_VALUE_FIELDS', {})
+    field_name = typed_fields.get(attribute.type)
+    if field_name:
+        return models.F(field_name), attr_class._meta.get_field(field_name)
+    cast_field_class = CAST_FIELDS.get(attribute.type)
+    if cast_field_class:
+        output_field = cast_field_class()
+        expression = Cast('value', output_field)
+    else:
+        # Text, and dates and times in ISO format, compare correctly as text
+        output_field = attr_class._meta.get_field('value')
+        expression = models.F('value')
+    pattern = VALID_TEXT_PATTERNS.get(attribute.type)
+    if pattern:
+        # Only cast valid texts, an empty or invalid text would make the cast fail on most databases
+        expression = Case(When(value__regex=pattern, then=expression), default=Value(None), output_field=output_field)
+    return expression, output_field
+
+
+def get_choice_pk(attribute, value):
+    """
+    Get the pk of the choice of an attribute with a value, None if there is no such choice
+    """
+    return metadata.get_choice_index(attribute.pk).get_pk(value)
+
+
+def prepare_value(attribute, value, as_text):
+    """
+    Convert a value used in a lookup to the type of the attribute
+
+    The values of attributes with choices are stored as the pks of the choices, so the value of a choice
+    (e.g. 'red') is converted to its pk. Boolean attributes only accept booleans, None or their texts.
+    """
+    if isinstance(value, six.string_types):
+        choice_pk = get_choice_pk(attribute, value)
+        if choice_pk is not None:
+            value = choice_pk
+        elif attribute.type != Attribute.TYPE_TEXT:
+            value = attribute.text_to_value(value)
+    if attribute.type == Attribute.TYPE_BOOLEAN and not (value is None or isinstance(value, bool)):
+        raise ValueError("Value '{value}' is not a valid boolean for attribute '{slug}'.".format(
+            value=value,
+            slug=attribute.slug,
+        ))
+    if as_text and hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return value
+
+
+def get_attr_filter(attr_class, attribute, lookup, value):
+    """
+    Get a queryset of attr_class rows for an attribute that match a lookup
+    """
+    queryset = attr_class.objects.filter(attribute_id=attribute.pk)
+    expression, output_field = get_value_expression(attr_class, attribute)
+    as_text = isinstance(output_field, models.CharField)
+    if lookup in MULTIPLE_VALUE_LOOKUPS:
+        value = [prepare_value(attribute, v, as_text) for v in value]
+    else:
+        value = prepare_value(attribute, value, as_text)
+    if as_text and attribute.type == Attribute.TYPE_BOOLEAN:
+        # Booleans stored as text can be written in several ways
+        if lookup != 'exact':
+            raise FieldError("Unsupported lookup '{lookup}' for boolean attribute '{slug}'.".format(
+                lookup=lookup,
+                slug=attribute.slug,
+            ))
+        if value is True:
+            texts = Attribute.BOOLEAN_TRUE_TEXTS
+        elif value is False:
+            texts = Attribute.BOOLEAN_FALSE_TEXTS
+        else:
+            texts = Attribute.BOOLEAN_NULL_TEXTS
+        condition = Q()
+        for text in texts:
+            condition |= Q(value__iexact=text)
+        return queryset.filter(condition)
+    queryset = queryset.annotate(mav_value=expression)
+    return queryset.filter(**{'mav_value{sep}{lookup}'.format(sep=LOOKUP_SEP, lookup=lookup): value})
+
+
+def filter_attrs(queryset, **kwargs):
+    """
+    Filter a queryset by attribute values, e.g. filter_attrs(queryset, color='red', weight__gte=10)
+
+    Each condition compiles to a subquery on the attr table by attribute id, using the typed value
+    fields if the attr class has them, and a cast of the value otherwise. Use `slug__isnull=True` to
+    find objects that have no value for an attribute.
+    """
+    get_attr_class(queryset)
+    for key, value in kwargs.items():
+        slug, sep, lookup = key.partition(LOOKUP_SEP)
+        attribute = get_attribute(slug)
+        attr_class = get_attr_class(queryset, attribute)
+        if lookup == 'isnull':
+            attrs = attr_class.objects.filter(attribute_id=attribute.pk).values('object_id')
+            if value:
+                queryset = queryset.exclude(pk__in=attrs)
+            else:
+                queryset = queryset.filter(pk__in=attrs)
+            continue
+        attrs = get_attr_filter(attr_class, attribute, lookup or 'exact', value)
+        queryset = queryset.filter(pk__in=attrs.values('object_id'))
+    return queryset
+
+
+def get_attr_value_subquery(attr_class, attribute, typed=True):
+    """
+    Get a subquery that selects the value of an attribute for the object in the outer query
+    :param typed: Select the typed value (see get_value_expression) instead of the text value
+    """
+    if typed:
+        expression, output_field = get_value_expression(attr_class, attribute)
+    else:
+        expression, output_field = models.F('value'), attr_class._meta.get_field('value')
+    attrs = attr_class.objects.filter(
+        attribute_id=attribute.pk,
+        object_id=OuterRef('pk'),
+    ).annotate(mav_value=expression).values('mav_value')
+    return Subquery(attrs[:1], output_field=output_field)
+
+
+def order_by_attr(queryset, *slugs):
+    """
+    Order a queryset by attribute values, e.g. order_by_attr(queryset, '-weight', 'color')
+    """
+    get_attr_class(queryset)
+    ordering = []
+    for slug in slugs:
+        descending = slug.startswith('-')
+        attribute = get_attribute(slug.lstrip('-'))
+        alias = 'mav_order_{pk}'.format(pk=attribute.pk)
+        attr_class = get_attr_class(queryset, attribute)
+        queryset = queryset.annotate(**{alias: get_attr_value_subquery(attr_class, attribute)})
+        ordering.append('-' + alias if descending else alias)
+    return queryset.order_by(*ordering)
+
+
+def with_snapshots(queryset):
+    """
+    Fetch the attribute snapshots along with the objects, read them with mav.models.get_attr_snapshot
+    """
+    snapshot_class = get_attr_class(queryset).snapshot_class
+    if snapshot_class is None:
+        raise TypeError("Model {name} does not have mav snapshots.".format(name=queryset.model.__name__))
+    return queryset.select_related(snapshot_class._meta.get_field('object').remote_field.get_accessor_name())
+
+
+def with_mav(queryset):
+    """
+    Prefetch the attrs of the objects in a queryset, so their obj.mav mappings need no queries
+    """
+    get_attr_class(queryset)
+    return queryset.prefetch_related(
+        *[get_attrs_related_name(attr_class) for attr_class in get_attr_classes(queryset.model)]
+    )
+
+
+class AttrValuesIterable(ModelIterable):
+    """
+    Iterable that yields model instances with an attr_values dict of {slug: value}
+
+    Subclasses set attr_values to a tuple of (annotation alias, attribute) pairs.
+    """
+    attr_values = ()
+
+    def __iter__(self):
+        converters = [
+            (alias, attribute.slug, attribute.get_converter()) for alias, attribute in self.attr_values
+        ]
+        with instrument('attr_values', self.queryset.model, attribute_count=len(converters), using=self.queryset.db):
+            for obj in super(AttrValuesIterable, self).__iter__():
+                values = {}
+                for alias, slug, converter in converters:
+                    text = obj.__dict__.pop(alias, None)
+                    try:
+                        values[slug] = None if text is None else converter(text)
+                    except ValueError:
+                        values[slug] = None
+                obj.attr_values = values
+                yield obj
+
+
+def with_attr_values(queryset, *slugs):
+    """
+    Fetch the values of attributes along with the objects, e.g. with_attr_values(queryset, 'color', 'weight')
+
+    Each attribute is selected with a subquery in the same SQL query as the objects. The objects get
+    an attr_values dict of {slug: value} with typed values, None for missing or invalid values.
+    """
+    get_attr_class(queryset)
+    attr_values = list(getattr(queryset._iterable_class, 'attr_values', ()))
+    annotations = {}
+    for slug in slugs:
+        attribute = get_attribute(slug)
+        alias = 'mav_value_{pk}'.format(pk=attribute.pk)
+        attr_class = get_attr_class(queryset, attribute)
+        annotations[alias] = get_attr_value_subquery(attr_class, attribute, typed=False)
+        attr_values.append((alias, attribute))
+    queryset = queryset.annotate(**annotations)
+    queryset._iterable_class = type(
+        str('AttrValuesIterable'),
+        (AttrValuesIterable,),
+        {'attr_values': tuple(attr_values)},
+    )
+    return queryset
+
+
+def get_object_filter(queryset):
+    """
+    Get the filter that restricts attrs to the objects in a queryset of their model, None for all objects
+    """
+    if not queryset.query.can_filter():
+        # A sliced queryset, select the ids first as not all databases support LIMIT in a subquery
+        return {'object_id__in': list(queryset.values_list('pk', flat=True))}
+    if queryset.query.has_filters():
+        return {'object_id__in': queryset.values('pk')}
+    return None
+
+
+def attr_bags(queryset, *slugs):
+    """
+    Read the attribute values of the objects in a queryset as AttrBag instances, e.g. attr_bags(queryset, 'color')
+
+    Values are read with a single query (one per attribute type with split storage) without creating model
+    instances, and streamed ordered by object id. Objects without values (for the given attributes) are skipped.
+    The values are read from the database of the queryset.
+    """
+    get_attr_class(queryset)
+    attribute_ids = [get_attribute(slug).pk for slug in slugs]
+    using = queryset.db
+    object_filter = get_object_filter(queryset)
+    querysets = []
+    for attr_class in get_attr_classes(queryset.model):
+        attrs = attr_class.objects.using(using)
+        if attribute_ids:
+            attrs = attrs.filter(attribute_id__in=attribute_ids)
+        if object_filter is not None:
+            attrs = attrs.filter(**object_filter)
+        querysets.append(attrs)
+    rows = iter_attr_rows(querysets)
+    for object_id, object_rows in groupby(rows, key=lambda row: row[0]):
+        yield AttrBag(object_id, dict((attribute_id, text) for _, attribute_id, text in object_rows))
+
+
+class MavQuerySetMixin(object):
+    """
+    Mixin to add attribute queries to a QuerySet of a model with mav
+    """
+
+    def filter_attrs(self, **kwargs):
+        return filter_attrs(self, **kwargs)
+
+    def order_by_attr(self, *slugs):
+        return order_by_attr(self, *slugs)
+
+    def with_attr_values(self, *slugs):
+        return with_attr_values(self, *slugs)
+
+    def with_snapshots(self):
+        return with_snapshots(self)
+
+    def attr_bags(self, *slugs):
+        return attr_bags(self, *slugs)
+
+    def with_mav(self):
+        return with_mav(self)
+
+
+class MavQuerySet(MavQuerySetMixin, models.QuerySet):
+    """
+    QuerySet for models with mav
+    """
+    pass
+
+
+MavManager = models.Manager.from_queryset(MavQuerySet)
+
+
+def install_manager(model, name='objects'):
+    """
+    Replace a plain Manager of a model with a MavManager
+    :param model: The model class with mav
+    :param name: The name of the manager
+    :return: True if the manager has been installed, False if the model has a custom manager with that name
+    """
+    manager = getattr(model, name, None)
+    if manager is not None and type(manager) is not models.Manager:
+        # Leave custom managers alone, their QuerySet can use MavQuerySetMixin
+        return False
+    model._meta.local_managers = [m for m in model._meta.local_managers if m.name != name]
+    model.add_to_class(name, MavManager())
+    return True
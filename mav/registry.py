@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.apps import apps
+
+
+# Dict of {model: generated attr class}, in the order the models were decorated (see add_mav_to)
+_registry = OrderedDict()
+
+
+def register(model, attr_class):
+    """
+    Register a model with mav and its generated attr class (the class for text attributes with split storage)
+    """
+    _registry[model] = attr_class
+
+
+def is_registered(model):
+    """
+    Return True if mav was added to a model
+    """
+    return model in _registry
+
+
+def get_attr_class(model):
+    """
+    Get the generated attr class of a model with mav
+    :raises LookupError: If the model does not have mav
+    """
+    try:
+        return _registry[model]
+    except KeyError:
+        raise LookupError('Model {label} does not have mav.'.format(label=model._meta.label))
+
+
+def get_mav_models():
+    """
+    Return the models with mav, once all models are loaded
+    """
+    apps.check_models_ready()
+    return list(_registry)
@@ -0,0 +1,68 @@
+from __future__ import unicode_literals
+
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+def is_mav_model(model):
+    """
+    Return True for the metadata models of mav and the generated attr and snapshot classes
+    """
+    from .models import (
+        AbstractModelAttribute, AbstractModelAttributeSnapshot, Attribute, AttributeSet, AttributeSetMembership,
+        Choice, Unit,
+    )
+    return issubclass(model, (
+        Attribute, Choice, Unit, AttributeSet, AttributeSetMembership, AbstractModelAttribute,
+        AbstractModelAttributeSnapshot,
+    ))
+
+
+class ReplicaRouter(object):
+    """
+    Database router that sends reads of attribute metadata and attrs to replicas, and writes to the primary
+
+    Add 'mav.routers.ReplicaRouter' to DATABASE_ROUTERS (before routers that route everything) and set
+    MAV_REPLICA_DATABASES to the aliases of the replicas, and MAV_PRIMARY_DATABASE to the alias of the primary
+    (default 'default'). Reads go to a random replica, except inside a transaction on the primary, so changes
+    are seen before they are committed. Other models are left to the other routers. The metadata registry loads
+    attributes with router.db_for_write, so it never caches the rows of a replica that lags behind.
+    """
+
+    def get_primary(self):
+        return getattr(settings, 'MAV_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+    def get_replicas(self):
+        return getattr(settings, 'MAV_REPLICA_DATABASES', ())
+
+    def db_for_read(self, model, **hints):
+        if not is_mav_model(model):
+            return None
+        primary = self.get_primary()
+        replicas = self.get_replicas()
+        if not replicas or transaction.get_connection(primary).in_atomic_block:
+            return primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not is_mav_model(model):
+            return None
+        return self.get_primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not (is_mav_model(type(obj1)) or is_mav_model(type(obj2))):
+            return None
+        databases = set(self.get_replicas())
+        databases.add(self.get_primary())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        model = hints.get('model')
+        if model is not None and is_mav_model(model) and db in self.get_replicas():
+            # Replicas get their tables from the primary
+            return False
+        return None
@@ -2,18 +2,69 @@
 from __future__ import unicode_literals
 
 import datetime
-from django.db import models
+import json
+import unittest
 
-from django.test import TestCase
+from django import forms
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.auth.models import Permission, User
+from django.core.exceptions import ImproperlyConfigured, MultipleObjectsReturned, ObjectDoesNotExist
+from django.core.management import call_command
+from django.db import connection, models
+from django.forms import modelformset_factory
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, translation
 
 from model_mommy import mommy
 from mav.decorators import mav
 
-from .models import Attribute
+from . import aio, bulk, registry
+from .admin import MavAdminMixin, attribute_list_filter
+from .bulk import import_values, read_csv, save_attribute_values
+from .converters import convert_many, get_converter
+from .export import stream
+from .facets import facets
+from .forms import (
+    FIELD_PREFIX, BaseModelFormSetWithAttrs, ModelFormWithAttrs, RelaxedFloatField, add_attribute_fields_to_form,
+    field_specs,
+)
+from .instrumentation import InstrumentationMiddleware, collect, operation_finished
+from .metadata import Metadata, metadata
+from .models import (
+    Attribute, AttributeSet, AttributeSetMembership, Choice, get_attr_snapshot, get_deleting_objects,
+    get_pending_refreshes,
+)
+from .query import MavManager
+from .routers import ReplicaRouter
 
 @mav
 class Foo(models.Model):
     name = models.CharField(max_length=100)
+    attribute_set = models.ForeignKey('mav.AttributeSet', null=True, blank=True)
+
+
+@mav(typed_values=True)
+class Bar(models.Model):
+    name = models.CharField(max_length=100)
+
+
+@mav(snapshot=True, prune_empty=True)
+class Baz(models.Model):
+    name = models.CharField(max_length=100)
+
+
+@mav(split_by_type=True)
+class Qux(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class FooForm(ModelFormWithAttrs):
+    class Meta:
+        model = Foo
+        fields = ['name']
 
 
 class ValueTestCase(TestCase):
@@ -107,3 +158,1430 @@ class ValueTestCase(TestCase):
         self.assertEqual(attr.value, 'foobar')
         self.assertEqual(attr.object, foo)
         self.assertEqual(attr.attribute, bar)
+
+
+class SaveAttributeValuesTestCase(TestCase):
+    def setUp(self):
+        self.foo = Foo.objects.create(name='foo')
+        self.attributes = [
+            mommy.make(Attribute, slug='attribute_{}'.format(i), type=Attribute.TYPE_TEXT)
+            for i in range(3)
+        ]
+
+    def test_save_attribute_values(self):
+        """
+        Test creating, updating and skipping attribute values in a constant number of queries
+        """
+        values = dict((attribute.pk, 'value') for attribute in self.attributes)
+        # Dates and times are normalized with the metadata, which is loaded once per process
+        metadata.get_index()
+        # Select, insert and a savepoint
+        with self.assertNumQueries(4):
+            self.assertEqual((3, 0, 0), save_attribute_values(self.foo, values))
+        values[self.attributes[0].pk] = 'changed'
+        values[self.attributes[1].pk] = None
+        # Select, update and a savepoint
+        with self.assertNumQueries(4):
+            self.assertEqual((0, 2, 0), save_attribute_values(self.foo, values))
+        stored = dict(self.foo.attrs.values_list('attribute_id', 'value'))
+        self.assertEqual({
+            self.attributes[0].pk: 'changed',
+            self.attributes[1].pk: '',
+            self.attributes[2].pk: 'value',
+        }, stored)
+
+    def test_save_attribute_fields(self):
+        """
+        Test saving the attribute fields of a form
+        """
+        FooAttr = Foo._mav_class
+        FooAttr.objects.create(object=self.foo, attribute=self.attributes[0], value='old')
+        form = FooForm(instance=self.foo, data={
+            'name': 'foo',
+            '{}{}'.format(FIELD_PREFIX, self.attributes[0].pk): 'new',
+        })
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual('new', self.foo.attrs.get(attribute=self.attributes[0]).value)
+
+    def test_concurrent_create(self):
+        """
+        Test that attributes another transaction creates after they were read are read again and updated
+        """
+        save_attribute_values(self.foo, {self.attributes[0].pk: 'theirs'})
+        get_existing_attrs = bulk.get_existing_attrs
+        calls = []
+
+        def get_existing_attrs_too_early(*args):
+            # The first read misses the attribute, as if it was created right after
+            calls.append(args)
+            return [] if len(calls) == 1 else get_existing_attrs(*args)
+
+        bulk.get_existing_attrs = get_existing_attrs_too_early
+        try:
+            self.assertEqual((0, 1, 0), save_attribute_values(self.foo, {self.attributes[0].pk: 'ours'}))
+            self.assertEqual(2, len(calls))
+            # An import reports the rows it cannot save, and imports the other chunks
+            bulk.get_existing_attrs = lambda *args: []
+            result = import_values(Foo, [
+                (self.foo.pk, self.attributes[0].slug, 'again'),
+                (self.foo.pk, self.attributes[1].slug, 'new'),
+            ], chunk_size=1)
+        finally:
+            bulk.get_existing_attrs = get_existing_attrs
+        self.assertEqual('ours', self.foo.attrs.get(attribute=self.attributes[0]).value)
+        self.assertEqual([1], [number for number, row, reason in result.rejected])
+        self.assertEqual(1, result.created)
+
+
+class MetadataTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.unit = mommy.make('mav.Unit', name='kilogram', symbol='kg')
+        self.attribute = mommy.make(Attribute, slug='weight', name='weight', type=Attribute.TYPE_INTEGER, unit=self.unit)
+        self.choice_b = mommy.make(Choice, attribute=self.attribute, name='b', sort_order=1)
+        self.choice_a = mommy.make(Choice, attribute=self.attribute, name='a', sort_order=1)
+        self.choice_z = mommy.make(Choice, attribute=self.attribute, name='z', sort_order=0)
+
+    def test_metadata_is_loaded_once(self):
+        """
+        Test that attribute metadata is read from the database only once
+        """
+        with self.assertNumQueries(3):
+            metadata.get_index()
+        with self.assertNumQueries(0):
+            self.assertEqual('weight (kg)', self.attribute.get_label())
+            self.assertEqual(
+                [self.choice_z.pk, self.choice_a.pk, self.choice_b.pk],
+                [pk for pk, name in self.attribute.get_choices()],
+            )
+            self.assertEqual('a', self.attribute.get_value_display(self.choice_a.pk))
+            self.assertEqual(self.attribute, metadata.get_attribute_by_slug('weight'))
+
+    def test_choice_index(self):
+        """
+        Test choice display lookups for many attributes
+        """
+        color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        red = mommy.make(Choice, attribute=color, value='R', name='red')
+        metadata.get_index()
+        with self.assertNumQueries(0):
+            self.assertEqual('red', color.get_value_display(red.pk))
+            self.assertEqual('red', color.get_value_display('R'))
+            self.assertEqual('{}'.format(self.choice_a.pk), color.get_value_display(self.choice_a.pk))
+            self.assertEqual([(red.pk, 'red')], color.get_choices())
+            self.assertEqual(3, len(metadata.get_choice_index(self.attribute.pk)))
+            self.assertFalse(metadata.get_choice_index(0))
+
+    def test_choice_displays_are_not_frozen(self):
+        """
+        Test that choice displays are read from the choices when needed, so translated names follow the language
+        """
+        metadata.get_index()
+        metadata.get_choice(self.choice_a.pk).name = 'A'
+        self.assertEqual('A', self.attribute.get_value_display(self.choice_a.pk))
+        self.assertIn((self.choice_a.pk, 'A'), self.attribute.get_choices())
+
+    def test_metadata_is_invalidated(self):
+        """
+        Test that saving or deleting metadata invalidates the loaded metadata
+        """
+        metadata.get_index()
+        self.unit.symbol = 'KG'
+        self.unit.save()
+        self.assertEqual('weight (KG)', self.attribute.get_label())
+        self.choice_a.delete()
+        self.assertEqual(2, len(self.attribute.get_choices()))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        MAV_METADATA_CACHE='default',
+        MAV_METADATA_CHECK_INTERVAL=0,
+    )
+    def test_shared_metadata(self):
+        """
+        Test that processes sharing a cache see each others changes
+        """
+        other = Metadata()
+        metadata.get_index()
+        other.get_index()
+        with self.assertNumQueries(0):
+            Metadata().get_index()
+        version = metadata.version
+        other.invalidate()
+        self.assertNotEqual(version, metadata.version)
+        with self.assertNumQueries(3):
+            metadata.get_index()
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        MAV_METADATA_CHECK_INTERVAL=0,
+    )
+    def test_shared_version(self):
+        """
+        Test that processes see each others changes through the default cache, without sharing the data
+        """
+        other = Metadata()
+        metadata.get_index()
+        with self.assertNumQueries(3):
+            other.get_index()
+        version = metadata.version
+        other.invalidate()
+        self.assertNotEqual(version, metadata.version)
+        with self.assertNumQueries(3):
+            metadata.get_index()
+
+    @override_settings(MAV_METADATA_MAX_AGE=60)
+    def test_max_age(self):
+        """
+        Test that the data is reloaded after MAV_METADATA_MAX_AGE seconds
+        """
+        metadata.get_index()
+        with self.assertNumQueries(0):
+            metadata.get_index()
+        metadata._loaded -= 61
+        with self.assertNumQueries(3):
+            metadata.get_index()
+
+
+class AttributeSetTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.unit = mommy.make('mav.Unit', symbol='kg')
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER, unit=self.unit)
+        self.red = mommy.make(Choice, attribute=self.color, value='R', name='red')
+        self.attribute_set = AttributeSet.objects.create(slug='fruit', name='fruit')
+        AttributeSetMembership.objects.create(attribute_set=self.attribute_set, attribute=self.weight, sort_order=1)
+        AttributeSetMembership.objects.create(attribute_set=self.attribute_set, attribute=self.color, sort_order=0)
+
+    def test_schema(self):
+        """
+        Test that the schema of an attribute set is resolved once
+        """
+        metadata.get_index()
+        with self.assertNumQueries(1):
+            schema = self.attribute_set.get_schema()
+        with self.assertNumQueries(0):
+            self.assertIs(schema, metadata.get_schema(self.attribute_set.pk))
+            self.assertEqual(['color', 'weight'], schema.slugs)
+            self.assertEqual('red', schema.choice_indexes[self.color.pk].get_display(self.red.pk))
+            self.assertEqual(self.unit, schema.units[self.weight.pk])
+        AttributeSetMembership.objects.filter(attribute=self.color).get().delete()
+        self.assertEqual(['weight'], metadata.get_schema(self.attribute_set.pk).slugs)
+
+    def test_form_uses_attribute_set(self):
+        """
+        Test that forms get the attributes from the attribute set of the instance
+        """
+        foo = Foo.objects.create(name='a', attribute_set=self.attribute_set)
+        form = FooForm(instance=foo)
+        self.assertEqual(
+            ['name', FIELD_PREFIX + '{}'.format(self.color.pk), FIELD_PREFIX + '{}'.format(self.weight.pk)],
+            list(form.fields),
+        )
+
+    def test_export_attribute_set(self):
+        """
+        Test exporting the attributes of an attribute set
+        """
+        foo = Foo.objects.create(name='a')
+        save_attribute_values(foo, {self.color.pk: 'R', self.weight.pk: '10'})
+        out = six.StringIO()
+        call_command('mav_export', 'mav.Foo', attribute_set='fruit', stdout=out)
+        self.assertEqual(['object_id,color,weight', '{},R,10'.format(foo.pk)], out.getvalue().splitlines())
+
+
+class AttrQueriesTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.foo = Foo.objects.create(name='foo')
+        for i in range(5):
+            attribute = mommy.make(Attribute, slug='attribute_{}'.format(i), name='', type=Attribute.TYPE_TEXT)
+            Foo._mav_class.objects.create(object=self.foo, attribute=attribute, value='value {}'.format(i))
+        metadata.get_index()
+
+    def test_form_queries(self):
+        """
+        Test that building a form costs a constant number of queries
+        """
+        with self.assertNumQueries(1):
+            form = FooForm(instance=self.foo)
+        self.assertEqual(6, len(form.fields))
+
+    def test_attr_display_queries(self):
+        """
+        Test that displaying attrs does not query each attribute
+        """
+        with self.assertNumQueries(1):
+            texts = [six.text_type(attr) for attr in self.foo.attrs.all()]
+        self.assertIn('attribute_0 = value 0', texts)
+        with self.assertNumQueries(1):
+            attrs = list(self.foo.attrs.with_attributes())
+        with self.assertNumQueries(0):
+            [attr.attribute.unit for attr in attrs]
+
+
+class TypedValuesTestCase(TestCase):
+    def setUp(self):
+        self.bar = Bar.objects.create(name='bar')
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.date = mommy.make(Attribute, slug='date', type=Attribute.TYPE_DATE)
+
+    def test_typed_values(self):
+        """
+        Test that typed values are set on save and can be queried
+        """
+        BarAttr = Bar._mav_class
+        attr = BarAttr.objects.create(object=self.bar, attribute=self.weight, value='12')
+        self.assertEqual(12, attr.value_int)
+        self.assertIsNone(attr.value_date)
+        attr.value = 'not a number'
+        attr.save()
+        self.assertIsNone(attr.value_int)
+        save_attribute_values(self.bar, {self.weight.pk: 20, self.date.pk: datetime.date(2000, 2, 29)})
+        self.assertTrue(BarAttr.objects.filter(attribute=self.weight, value_int__gt=10).exists())
+        self.assertTrue(BarAttr.objects.filter(
+            attribute=self.date,
+            value_date__range=(datetime.date(2000, 1, 1), datetime.date(2000, 12, 31)),
+        ).exists())
+
+
+class QueryTestCase(TestCase):
+    def setUp(self):
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.available = mommy.make(Attribute, slug='available', type=Attribute.TYPE_BOOLEAN)
+        self.date = mommy.make(Attribute, slug='date', type=Attribute.TYPE_DATE)
+        self.foos = []
+        self.bars = []
+        for name, color, weight, available, date in (
+            ('a', 'red', '9', 'yes', '2000-01-01'),
+            ('b', 'red', '10', 'no', '2001-01-01'),
+            ('c', 'blue', '100', 'TRUE', '2002-01-01'),
+        ):
+            values = {
+                self.color.pk: color,
+                self.weight.pk: weight,
+                self.available.pk: available,
+                self.date.pk: date,
+            }
+            foo = Foo.objects.create(name=name)
+            save_attribute_values(foo, values)
+            self.foos.append(foo)
+            bar = Bar.objects.create(name=name)
+            save_attribute_values(bar, values)
+            self.bars.append(bar)
+
+    def test_manager_is_installed(self):
+        """
+        Test that the mav decorator installs a MavManager
+        """
+        self.assertIsInstance(Foo.objects, MavManager)
+        self.assertIsInstance(Foo._default_manager, MavManager)
+
+    def test_filter_attrs(self):
+        """
+        Test filtering by attribute values, with and without typed values
+        """
+        for model, objects in ((Foo, self.foos), (Bar, self.bars)):
+            a, b, c = objects
+            self.assertEqual([a, b], list(model.objects.filter_attrs(color='red').order_by('pk')))
+            self.assertEqual([b, c], list(model.objects.filter_attrs(weight__gte=10).order_by('pk')))
+            self.assertEqual([b], list(model.objects.filter_attrs(color='red', weight__gte='10')))
+            self.assertEqual([a, c], list(model.objects.filter_attrs(available=True).order_by('pk')))
+            self.assertEqual([b], list(model.objects.filter_attrs(
+                date__range=(datetime.date(2000, 6, 1), '2001-06-01'),
+            )))
+            self.assertEqual([], list(model.objects.filter_attrs(color__isnull=True)))
+
+    def test_invalid_values(self):
+        """
+        Test that empty and invalid values are treated as missing, and dates are compared in ISO format
+        """
+        for model, objects in ((Foo, self.foos), (Bar, self.bars)):
+            a, b, c = objects
+            d = model.objects.create(name='d')
+            save_attribute_values(d, {self.weight.pk: '', self.date.pk: '2000-1-5'})
+            e = model.objects.create(name='e')
+            save_attribute_values(e, {self.weight.pk: 'heavy', self.date.pk: 'soon'})
+            self.assertEqual([a], list(model.objects.filter_attrs(weight__lte=9)))
+            self.assertEqual([c, b, a], list(model.objects.filter_attrs(weight__gte=0).order_by_attr('-weight')))
+            self.assertEqual([a, d], list(model.objects.filter_attrs(
+                date__range=('2000-01-01', '2000-01-31'),
+            ).order_by_attr('date')))
+            self.assertEqual('2000-01-05', d.attrs.get(attribute=self.date).value)
+
+    def test_normalize_on_save(self):
+        """
+        Test that dates are also stored in ISO format when attrs are created, saved or cleaned one by one
+        """
+        for model in (Foo, Bar):
+            obj = model.objects.create(name='d')
+            attr = model._mav_class.objects.create(object=obj, attribute=self.date, value='2000-1-5')
+            self.assertEqual('2000-01-05', model._mav_class.objects.get(pk=attr.pk).value)
+            attr.value = '2000-2-3'
+            attr.clean()
+            self.assertEqual('2000-02-03', attr.value)
+            attr.value = 'soon'
+            attr.save()
+            self.assertEqual('soon', model._mav_class.objects.get(pk=attr.pk).value)
+
+    def test_choice_values(self):
+        """
+        Test filtering attributes with choices by the values of the choices, which are stored as their pks
+        """
+        size = mommy.make(Attribute, slug='size', type=Attribute.TYPE_INTEGER)
+        small = mommy.make(Choice, attribute=size, value='small')
+        large = mommy.make(Choice, attribute=size, value='large')
+        shape = mommy.make(Attribute, slug='shape', type=Attribute.TYPE_TEXT)
+        round_ = mommy.make(Choice, attribute=shape, value='round')
+        for model, objects in ((Foo, self.foos), (Bar, self.bars)):
+            a, b, c = objects
+            save_attribute_values(a, {size.pk: small.pk, shape.pk: round_.pk})
+            save_attribute_values(b, {size.pk: large.pk})
+            self.assertEqual([a], list(model.objects.filter_attrs(size='small')))
+            self.assertEqual([a, b], list(model.objects.filter_attrs(size__in=['small', large.pk]).order_by('pk')))
+            self.assertEqual([a], list(model.objects.filter_attrs(shape='round')))
+            self.assertEqual([], list(model.objects.filter_attrs(shape='square')))
+
+    def test_invalid_boolean(self):
+        """
+        Test that boolean attributes can only be compared to booleans
+        """
+        for model in (Foo, Bar):
+            self.assertEqual(2, model.objects.filter_attrs(available='yes').count())
+            self.assertRaises(ValueError, model.objects.filter_attrs, available=1)
+            self.assertRaises(ValueError, model.objects.filter_attrs, available='maybe')
+
+    def test_order_by_attr(self):
+        """
+        Test ordering by attribute values
+        """
+        for model, objects in ((Foo, self.foos), (Bar, self.bars)):
+            a, b, c = objects
+            self.assertEqual([c, b, a], list(model.objects.order_by_attr('-weight')))
+            self.assertEqual([c, a, b], list(model.objects.order_by_attr('color', 'weight')))
+
+    def test_with_attr_values(self):
+        """
+        Test fetching typed attribute values for many objects in one query
+        """
+        for model in (Foo, Bar):
+            with self.assertNumQueries(1):
+                objects = list(model.objects.with_attr_values('color', 'weight').with_attr_values('date').order_by('pk'))
+            self.assertEqual(
+                {'color': 'red', 'weight': 9, 'date': datetime.date(2000, 1, 1)},
+                objects[0].attr_values,
+            )
+            self.assertEqual(100, objects[2].attr_values['weight'])
+            unknown = model.objects.create(name='unknown')
+            self.assertEqual(
+                {'color': None},
+                model.objects.filter(pk=unknown.pk).with_attr_values('color').get().attr_values,
+            )
+
+    def test_attr_bags(self):
+        """
+        Test reading typed attribute values into compact bags
+        """
+        metadata.get_index()
+        with self.assertNumQueries(1):
+            bags = list(Foo.objects.attr_bags())
+        self.assertEqual([foo.pk for foo in self.foos], [bag.object_id for bag in bags])
+        self.assertFalse(hasattr(bags[0], '__dict__'))
+        self.assertEqual(9, bags[0]['weight'])
+        self.assertEqual(True, bags[0].get('available'))
+        self.assertEqual('9', bags[0].get_text('weight'))
+        self.assertEqual(
+            {'color': 'red', 'weight': 9, 'available': True, 'date': datetime.date(2000, 1, 1)},
+            bags[0].as_dict(),
+        )
+        bags = list(Foo.objects.order_by('-pk')[:2].attr_bags('color'))
+        self.assertEqual([self.foos[1].pk, self.foos[2].pk], [bag.object_id for bag in bags])
+        bags = list(Foo.objects.filter(name='c').attr_bags('color'))
+        self.assertEqual([{'color': 'blue'}], [bag.as_dict() for bag in bags])
+        self.assertNotIn('weight', bags[0])
+        self.assertIsNone(bags[0].get('weight'))
+        with self.assertRaises(KeyError):
+            bags[0]['weight']
+
+
+class ConvertersTestCase(TestCase):
+    def test_convert_many(self):
+        """
+        Test converting many texts at once, reporting errors without raising
+        """
+        attribute = mommy.make(Attribute, type=Attribute.TYPE_DATE)
+        values, errors = convert_many(attribute, ['2000-02-29', 'not a date', '2000-2'])
+        self.assertEqual([datetime.date(2000, 2, 29), None, None], values)
+        self.assertEqual([1, 2], sorted(errors))
+        self.assertIsInstance(errors[1], ValueError)
+
+    def test_register_converter(self):
+        """
+        Test that every attribute type has a converter
+        """
+        for attribute_type, name in Attribute.CHOICES_FOR_TYPE:
+            self.assertIsNotNone(get_converter(attribute_type))
+        self.assertEqual(get_converter(Attribute.TYPE_TIME), Attribute(type=Attribute.TYPE_TIME).get_converter())
+        with self.assertRaises(ValueError):
+            Attribute(type=0).text_to_value('text')
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.foos = [Foo.objects.create(name=name) for name in ('a', 'b', 'c')]
+        save_attribute_values(self.foos[0], {self.color.pk: 'red', self.weight.pk: '10'})
+        save_attribute_values(self.foos[2], {self.weight.pk: 'heavy'})
+
+    def test_stream(self):
+        """
+        Test streaming objects with attributes in chunks
+        """
+        self.assertEqual([
+            (self.foos[0].pk, {'color': 'red', 'weight': 10}),
+            (self.foos[2].pk, {'weight': None}),
+        ], list(stream(Foo, chunk_size=1)))
+        self.assertEqual(
+            [(self.foos[0].pk, {'color': 'red'})],
+            list(stream(Foo, attributes=['color'])),
+        )
+
+    def test_export_command(self):
+        """
+        Test the mav_export management command
+        """
+        out = six.StringIO()
+        call_command('mav_export', 'mav.Foo', format='jsonl', attributes='weight', stdout=out)
+        self.assertEqual([
+            {'object_id': self.foos[0].pk, 'attrs': {'weight': 10}},
+            {'object_id': self.foos[2].pk, 'attrs': {'weight': None}},
+        ], [json.loads(line) for line in out.getvalue().splitlines()])
+        out = six.StringIO()
+        call_command('mav_export', 'mav.Foo', stdout=out)
+        self.assertEqual(['object_id,color,weight', '{},red,10'.format(self.foos[0].pk)], out.getvalue().splitlines()[:2])
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.foo = Foo.objects.create(name='foo')
+        save_attribute_values(self.foo, {self.color.pk: 'red'})
+
+    def test_import_values(self):
+        """
+        Test importing values, with rejected rows
+        """
+        result = import_values(Foo, [
+            (self.foo.pk, 'color', 'blue'),
+            (str(self.foo.pk), 'weight', '10'),
+            (self.foo.pk, 'weight', 'heavy'),
+            (self.foo.pk + 1, 'color', 'red'),
+            (self.foo.pk, 'unknown', 'red'),
+            ('not a pk', 'color', 'red'),
+        ], chunk_size=1)
+        self.assertEqual(6, result.rows)
+        self.assertEqual(1, result.created)
+        self.assertEqual(1, result.updated)
+        self.assertEqual([3, 4, 5, 6], [number for number, row, reason in result.rejected])
+        self.assertEqual({'color': 'blue', 'weight': 10}, dict(
+            (attr.attribute.slug, attr.get_value()) for attr in self.foo.attrs.all()
+        ))
+        result = import_values(Foo, [(self.foo.pk, 'color', 'green')], update=False)
+        self.assertEqual(0, result.updated)
+        self.assertEqual('blue', self.foo.attrs.get(attribute=self.color).value)
+
+    def test_import_normalizes_values(self):
+        """
+        Test that imported values are stored as converted by the attribute converter
+        """
+        date = mommy.make(Attribute, slug='date', type=Attribute.TYPE_DATE)
+        result = import_values(Foo, [(self.foo.pk, 'weight', ' 010 '), (self.foo.pk, 'date', '2000-1-5')])
+        self.assertEqual([], result.rejected)
+        self.assertEqual('10', self.foo.attrs.get(attribute=self.weight).value)
+        self.assertEqual('2000-01-05', self.foo.attrs.get(attribute=date).value)
+
+    def test_read_csv(self):
+        """
+        Test reading rows from both CSV formats
+        """
+        self.assertEqual(
+            [('1', 'color', 'red')],
+            list(read_csv(six.StringIO('object_id,attribute,value\r\n1,color,red\r\n'))),
+        )
+        self.assertEqual(
+            [('1', 'color', 'red'), ('2', 'weight', '10')],
+            list(read_csv(six.StringIO('object_id,color,weight\r\n1,red,\r\n2,,10\r\n'))),
+        )
+
+
+class RelaxedFloatFieldTestCase(SimpleTestCase):
+    def test_clean(self):
+        """
+        Test cleaning floats with a comma or point as decimal separator
+        """
+        field = RelaxedFloatField(required=False)
+        self.assertEqual(1.5, field.clean('1,5'))
+        self.assertEqual(1.5, field.clean('1.5'))
+        self.assertEqual(2.0, field.clean(2))
+        self.assertRaises(forms.ValidationError, field.clean, '1,000.5')
+
+
+class FieldSpecCacheTestCase(TestCase):
+    def setUp(self):
+        self.unit = mommy.make('mav.Unit', symbol='kg')
+        self.weight = mommy.make(Attribute, slug='weight', name='weight', type=Attribute.TYPE_INTEGER, unit=self.unit)
+        self.foo = Foo.objects.create(name='foo')
+        save_attribute_values(self.foo, {self.weight.pk: 10})
+
+    def test_fields_are_copied(self):
+        """
+        Test that forms get their own copies of the cached fields
+        """
+        field_name = '{}{}'.format(FIELD_PREFIX, self.weight.pk)
+        form = FooForm(instance=self.foo)
+        self.assertEqual('10', form.fields[field_name].initial)
+        self.assertIs(
+            field_specs.get_fields([self.weight])[field_name],
+            field_specs.get_fields([self.weight])[field_name],
+        )
+        other = FooForm(instance=self.foo)
+        self.assertIsNot(form.fields[field_name], other.fields[field_name])
+        self.assertEqual('Weight (kg)', form.fields[field_name].label)
+
+    def test_fields_follow_metadata(self):
+        """
+        Test that the cached fields are rebuilt when the metadata changes
+        """
+        field_name = '{}{}'.format(FIELD_PREFIX, self.weight.pk)
+        FooForm(instance=self.foo)
+        self.unit.symbol = 'g'
+        self.unit.save()
+        self.assertEqual('Weight (g)', FooForm(instance=self.foo).fields[field_name].label)
+
+    def test_cache_size(self):
+        """
+        Test that the cache holds a field per attribute, however the attributes are combined on forms
+        """
+        metadata.clear()
+        attributes = [self.weight] + [
+            mommy.make(Attribute, slug='attribute_{}'.format(i), type=Attribute.TYPE_TEXT) for i in range(3)
+        ]
+        for i in range(len(attributes)):
+            field_specs.get_fields(attributes[i:] + attributes[:i])
+        self.assertEqual(4, len(field_specs._fields))
+
+    def test_languages(self):
+        """
+        Test that the cached fields are built per language, as the labels and choices can be translated
+        """
+        field_name = '{}{}'.format(FIELD_PREFIX, self.weight.pk)
+        with translation.override('en'):
+            field = field_specs.get_fields([self.weight])[field_name]
+            self.assertIs(field, field_specs.get_fields([self.weight])[field_name])
+        with translation.override('nl'):
+            self.assertIsNot(field, field_specs.get_fields([self.weight])[field_name])
+
+    def test_duplicate_attributes(self):
+        """
+        Test that listing an attribute twice does not give the other fields the wrong prototype
+        """
+        color = mommy.make(Attribute, slug='color', name='color', type=Attribute.TYPE_TEXT)
+        form = FooForm(instance=self.foo)
+        add_attribute_fields_to_form(form, [self.weight, self.weight, color], self.foo.attrs.all())
+        self.assertEqual('10', form.fields['{}{}'.format(FIELD_PREFIX, self.weight.pk)].initial)
+        self.assertIsInstance(form.fields['{}{}'.format(FIELD_PREFIX, self.weight.pk)], forms.IntegerField)
+        self.assertIsInstance(form.fields['{}{}'.format(FIELD_PREFIX, color.pk)], forms.CharField)
+
+
+class FormSetTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.foos = [Foo.objects.create(name=name) for name in ('a', 'b', 'c')]
+        for foo in self.foos:
+            save_attribute_values(foo, {self.color.pk: 'red'})
+        metadata.get_index()
+        self.FooFormSet = modelformset_factory(Foo, form=FooForm, formset=BaseModelFormSetWithAttrs, extra=0)
+
+    def test_formset_queries(self):
+        """
+        Test that a formset loads the attributes for all forms at once
+        """
+        with self.assertNumQueries(2):
+            formset = self.FooFormSet(queryset=Foo.objects.order_by('pk'))
+            forms = formset.forms
+        field_name = '{}{}'.format(FIELD_PREFIX, self.color.pk)
+        self.assertEqual(['red', 'red', 'red'], [form.fields[field_name].initial for form in forms])
+
+    def test_formset_save(self):
+        """
+        Test that a formset saves the attributes of all forms at once
+        """
+        field_name = '{}{}'.format(FIELD_PREFIX, self.color.pk)
+        data = {
+            'form-TOTAL_FORMS': '3',
+            'form-INITIAL_FORMS': '3',
+        }
+        for i, foo in enumerate(self.foos):
+            data['form-{}-id'.format(i)] = foo.pk
+            data['form-{}-name'.format(i)] = foo.name
+            data['form-{}-{}'.format(i, field_name)] = 'blue' if i else 'red'
+        formset = self.FooFormSet(data, queryset=Foo.objects.order_by('pk'))
+        self.assertTrue(formset.is_valid())
+        # Two changed objects, then select and update the attributes, and two savepoints
+        with self.assertNumQueries(8):
+            formset.save()
+        self.assertEqual(['red', 'blue', 'blue'], [foo.attrs.get().value for foo in self.foos])
+
+
+class SnapshotTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.birthday = mommy.make(Attribute, slug='birthday', type=Attribute.TYPE_DATE)
+        self.bazs = [Baz.objects.create(name=name) for name in ('a', 'b')]
+
+    def test_snapshot_follows_bulk_saves(self):
+        """
+        Test that saving attribute values in bulk refreshes the snapshots
+        """
+        save_attribute_values(self.bazs[0], {self.color.pk: 'red', self.birthday.pk: '2000-01-31'})
+        self.assertEqual(
+            {'color': 'red', 'birthday': datetime.date(2000, 1, 31)},
+            get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)),
+        )
+        import_values(Baz, [(self.bazs[1].pk, 'weight', '10')])
+        self.assertEqual({'weight': 10}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[1].pk)))
+        with self.assertNumQueries(1):
+            snapshots = [get_attr_snapshot(baz) for baz in Baz.objects.with_snapshots().order_by('pk')]
+        self.assertEqual(['red', None], [snapshot.get('color') for snapshot in snapshots])
+
+    def test_snapshot_follows_attr_saves(self):
+        """
+        Test that saving and deleting single attrs refreshes the snapshot
+        """
+        BazAttr = Baz._mav_class
+        attr = BazAttr.objects.create(object=self.bazs[0], attribute=self.weight, value='10')
+        self.assertEqual({'weight': 10}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)))
+        attr.value = 'heavy'
+        attr.save()
+        self.assertEqual({'weight': None}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)))
+        attr.delete()
+        self.assertEqual({}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)))
+        # Deleting an object deletes its attrs and its snapshot
+        save_attribute_values(self.bazs[0], {self.color.pk: 'red'})
+        self.bazs[0].delete()
+        self.assertFalse(BazAttr.snapshot_class.objects.filter(pk=self.bazs[0].pk).exists())
+
+    def test_object_delete_queries(self):
+        """
+        Test that deleting an object does not refresh its snapshot for every attr
+        """
+        metadata.get_index()
+        save_attribute_values(self.bazs[0], {self.color.pk: 'red'})
+        save_attribute_values(self.bazs[1], {
+            self.color.pk: 'red',
+            self.weight.pk: '10',
+            self.birthday.pk: '2000-01-31',
+        })
+        with CaptureQueriesContext(connection) as one_attr:
+            self.bazs[0].delete()
+        with CaptureQueriesContext(connection) as three_attrs:
+            self.bazs[1].delete()
+        self.assertEqual(len(one_attr), len(three_attrs))
+        self.assertFalse(get_deleting_objects())
+        self.assertFalse(Baz._mav_class.objects.exists())
+        self.assertFalse(Baz._mav_class.snapshot_class.objects.exists())
+
+    def test_attr_delete_queries(self):
+        """
+        Test that deleting many attrs refreshes the snapshots once
+        """
+        metadata.get_index()
+        bazs = self.bazs + [Baz.objects.create(name=name) for name in ('c', 'd')]
+        for baz in bazs:
+            save_attribute_values(baz, {self.color.pk: 'red', self.weight.pk: '10'})
+        with CaptureQueriesContext(connection) as one_attr:
+            Baz._mav_class.objects.filter(object=bazs[0], attribute=self.color).delete()
+        with CaptureQueriesContext(connection) as five_attrs:
+            Baz._mav_class.objects.exclude(object=bazs[0], attribute=self.weight).delete()
+        self.assertEqual(len(one_attr), len(five_attrs))
+        self.assertFalse(get_pending_refreshes())
+        self.assertEqual(
+            [{'weight': 10}, {}, {}, {}],
+            [get_attr_snapshot(baz) for baz in Baz.objects.with_snapshots().order_by('pk')],
+        )
+        # Deleting an attribute deletes its attrs together
+        self.weight.delete()
+        self.assertEqual({}, get_attr_snapshot(Baz.objects.get(pk=bazs[0].pk)))
+
+    def test_rebuild_command(self):
+        """
+        Test the rebuild_mav_snapshots management command
+        """
+        save_attribute_values(self.bazs[0], {self.color.pk: 'red'})
+        Baz._mav_class.snapshot_class.objects.all().delete()
+        self.assertEqual({}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)))
+        out = six.StringIO()
+        call_command('rebuild_mav_snapshots', 'mav.Baz', chunk_size=1, stdout=out)
+        self.assertIn('2 objects', out.getvalue())
+        self.assertEqual({'color': 'red'}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[0].pk)))
+        self.assertEqual({}, get_attr_snapshot(Baz.objects.get(pk=self.bazs[1].pk)))
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.foo = Foo.objects.create(name='a')
+        save_attribute_values(self.foo, {self.color.pk: 'red'})
+
+    def test_collect(self):
+        """
+        Test collecting instrumented operations with their query counts
+        """
+        metadata.get_index()
+        with CaptureQueriesContext(connection), collect() as collector:
+            FooForm(instance=self.foo)
+            list(Foo.objects.with_attr_values('color'))
+        self.assertEqual(['build_form', 'attr_values'], [record['operation'] for record in collector.records])
+        self.assertEqual(Foo, collector.records[0]['model'])
+        self.assertEqual(1, collector.records[0]['attribute_count'])
+        self.assertEqual(1, collector.records[0]['query_count'])
+        self.assertEqual(2, collector.query_count)
+        # Without queries logging, queries are counted without logging them
+        queries_log = list(connection.queries_log)
+        with collect() as collector:
+            FooForm(instance=self.foo)
+            list(Foo.objects.with_attr_values('color'))
+        self.assertEqual([1, 1], [record['query_count'] for record in collector.records])
+        self.assertFalse(connection.queries_logged)
+        self.assertEqual(queries_log, list(connection.queries_log))
+
+    def test_full_queries_log(self):
+        """
+        Test that queries are counted when the queries log is full, and that the log is left alone
+        """
+        metadata.get_index()
+        self.addCleanup(connection.queries_log.clear)
+        with CaptureQueriesContext(connection):
+            connection.queries_log.extend({'sql': '', 'time': '0'} for __ in range(connection.queries_log.maxlen))
+            with collect() as collector:
+                FooForm(instance=self.foo)
+                with collect() as inner:
+                    list(Foo.objects.with_attr_values('color'))
+            self.assertEqual([1], [record['query_count'] for record in inner.records])
+            self.assertEqual([1, 1], [record['query_count'] for record in collector.records])
+            self.assertEqual(
+                ['SELECT', 'SELECT'],
+                [query['sql'].split()[0] for query in list(connection.queries_log)[-2:]],
+            )
+
+    def test_signal(self):
+        """
+        Test that instrumented operations are sent to signal receivers
+        """
+        records = []
+
+        def receiver(sender, **kwargs):
+            records.append(kwargs['operation'])
+
+        operation_finished.connect(receiver)
+        try:
+            save_attribute_values(self.foo, {self.color.pk: 'blue'})
+        finally:
+            operation_finished.disconnect(receiver)
+        self.assertEqual(['save_attrs'], records)
+
+    @override_settings(MAV_INSTRUMENTATION_MAX_QUERIES=0)
+    def test_middleware(self):
+        """
+        Test that the middleware logs requests that exceed the thresholds
+        """
+        import logging
+
+        class Handler(logging.Handler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.messages = []
+
+            def emit(self, record):
+                self.messages.append((record.levelno, record.getMessage()))
+
+        handler = Handler()
+        logger = logging.getLogger('mav.instrumentation')
+        logger.addHandler(handler)
+
+        def view(request):
+            FooForm(instance=self.foo)
+            return HttpResponse()
+
+        try:
+            with CaptureQueriesContext(connection):
+                middleware = InstrumentationMiddleware(view)
+                middleware(RequestFactory().get('/foo/'))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(1, len(handler.messages))
+        self.assertEqual(logging.WARNING, handler.messages[0][0])
+        self.assertIn('GET /foo/', handler.messages[0][1])
+
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:
+    async_to_sync = None
+
+
+class AioTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.foos = [Foo.objects.create(name=name) for name in ('a', 'b')]
+        save_attribute_values(self.foos[0], {self.color.pk: 'red', self.weight.pk: '10'})
+
+    def test_get_attr_values(self):
+        """
+        Test getting the typed values of an instance in one query
+        """
+        metadata.get_index()
+        with self.assertNumQueries(1):
+            self.assertEqual({'color': 'red', 'weight': 10}, aio.get_attr_values(self.foos[0]))
+        with self.assertNumQueries(1):
+            self.assertEqual({'weight': 10}, aio.get_attr_values(self.foos[0], 'weight'))
+        self.assertEqual({}, aio.get_attr_values(self.foos[1]))
+
+    @unittest.skipIf(async_to_sync is None, 'asgiref is not installed')
+    def test_async(self):
+        """
+        Test the async counterparts from an event loop
+        """
+        metadata.clear()
+        async_to_sync(aio.aload_metadata)()
+        with self.assertNumQueries(0):
+            metadata.get_index()
+        self.assertEqual({'color': 'red', 'weight': 10}, async_to_sync(aio.aget_attr_values)(self.foos[0]))
+        self.assertEqual((0, 1, 0), async_to_sync(aio.asave_attribute_values)(
+            self.foos[0], {self.color.pk: 'blue', self.weight.pk: '10'}
+        ))
+        async_to_sync(aio.asave_many_attribute_values)([
+            (self.foos[0], {self.weight.pk: '20'}),
+            (self.foos[1], {self.color.pk: 'green'}),
+        ])
+        self.assertEqual({'color': 'blue', 'weight': 20}, aio.get_attr_values(self.foos[0]))
+        self.assertEqual({'color': 'green'}, aio.get_attr_values(self.foos[1]))
+
+    @unittest.skipIf(async_to_sync is not None, 'asgiref is installed')
+    def test_async_unavailable(self):
+        """
+        Test that the async counterparts require asgiref
+        """
+        self.assertRaises(ImproperlyConfigured, aio.aget_attr_values, self.foos[0])
+        self.assertRaises(ImproperlyConfigured, aio.aload_metadata)
+
+
+class PruneEmptyTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+
+    def test_empty_values_are_deleted(self):
+        """
+        Test that saving empty values deletes the attributes if prune_empty is set
+        """
+        baz = Baz.objects.create(name='a')
+        save_attribute_values(baz, {self.color.pk: 'red', self.weight.pk: '10'})
+        self.assertEqual((0, 0, 2), save_attribute_values(baz, {self.color.pk: None, self.weight.pk: ''}))
+        self.assertFalse(baz.attrs.exists())
+        self.assertEqual({}, get_attr_snapshot(Baz.objects.get(pk=baz.pk)))
+        # Empty values are not created either
+        self.assertEqual((1, 0, 0), save_attribute_values(baz, {self.color.pk: '', self.weight.pk: '10'}))
+        self.assertEqual([self.weight.pk], [attr.attribute_id for attr in baz.attrs.all()])
+        # Imports report the deleted attributes
+        save_attribute_values(baz, {self.color.pk: 'red'})
+        result = import_values(Baz, [(baz.pk, 'color', ''), (baz.pk, 'weight', '20')])
+        self.assertEqual((0, 1, 1), (result.created, result.updated, result.deleted))
+
+    def test_prune_command(self):
+        """
+        Test the mav_prune_empty management command
+        """
+        foos = [Foo.objects.create(name=name) for name in ('a', 'b')]
+        for foo in foos:
+            save_attribute_values(foo, {self.color.pk: '', self.weight.pk: '10'})
+        self.assertEqual(4, Foo._mav_class.objects.count())
+        out = six.StringIO()
+        call_command('mav_prune_empty', 'mav.Foo', chunk_size=1, stdout=out)
+        self.assertIn('Deleted 2 empty attributes', out.getvalue())
+        self.assertEqual([self.weight.pk] * 2, [attr.attribute_id for attr in Foo._mav_class.objects.all()])
+
+
+class SplitStorageTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.quxs = [Qux.objects.create(name=name) for name in ('a', 'b', 'c')]
+        for qux, color, weight in zip(self.quxs, ('red', 'blue', 'red'), ('10', '9', 'heavy')):
+            save_attribute_values(qux, {self.color.pk: color, self.weight.pk: weight})
+
+    def test_values_are_split_by_type(self):
+        """
+        Test that values are stored in the table for the type of their attribute
+        """
+        self.assertEqual(
+            ['mav_qux_attr_text', 'mav_qux_attr_boolean', 'mav_qux_attr_integer', 'mav_qux_attr_decimal',
+             'mav_qux_attr_date', 'mav_qux_attr_time'],
+            [attr_class._meta.db_table for attr_class in Qux._mav_classes],
+        )
+        self.assertEqual(['red', 'blue', 'red'], [attr.value for attr in Qux._mav_class.objects.order_by('pk')])
+        QuxAttrInteger = Qux._mav_classes_by_type[Attribute.TYPE_INTEGER]
+        self.assertEqual([10, 9, None], [attr.value_int for attr in QuxAttrInteger.objects.order_by('pk')])
+        self.assertFalse(hasattr(QuxAttrInteger, 'value_float'))
+        self.assertEqual((0, 1, 0), save_attribute_values(self.quxs[0], {self.color.pk: 'red', self.weight.pk: '11'}))
+
+    def test_attrs(self):
+        """
+        Test that the attrs of an object with split storage span the classes for all types
+        """
+        qux = self.quxs[0]
+        self.assertEqual(2, qux.attrs.count())
+        self.assertTrue(qux.attrs.exists())
+        self.assertEqual(['red', '10'], [attr.value for attr in qux.attrs.all()])
+        self.assertEqual(10, qux.attrs.get(attribute=self.weight).value_int)
+        self.assertEqual(['red'], [attr.value for attr in qux.attrs.exclude(attribute=self.weight)])
+        with self.assertRaises(ObjectDoesNotExist):
+            qux.attrs.get(attribute__slug='shape')
+        with self.assertRaises(MultipleObjectsReturned):
+            qux.attrs.get()
+        qux.attrs.delete()
+        self.assertFalse(qux.attrs.exists())
+
+    def test_type_change(self):
+        """
+        Test that changing the type of an attribute moves its values to the class for the new type
+        """
+        self.weight.type = Attribute.TYPE_DECIMAL
+        self.weight.save()
+        QuxAttrInteger = Qux._mav_classes_by_type[Attribute.TYPE_INTEGER]
+        QuxAttrDecimal = Qux._mav_classes_by_type[Attribute.TYPE_DECIMAL]
+        self.assertFalse(QuxAttrInteger.objects.exists())
+        self.assertEqual(
+            [(self.quxs[0].pk, '10', 10.0), (self.quxs[1].pk, '9', 9.0), (self.quxs[2].pk, 'heavy', None)],
+            list(QuxAttrDecimal.objects.order_by('object_id').values_list('object_id', 'value', 'value_float')),
+        )
+        self.assertEqual([self.quxs[1]], list(Qux.objects.filter_attrs(weight__lt=9.5)))
+        self.weight.name = 'Weight'
+        self.weight.save()
+        self.assertEqual(3, QuxAttrDecimal.objects.count())
+
+    def test_queries(self):
+        """
+        Test the attribute queries on split storage
+        """
+        self.assertEqual([self.quxs[1]], list(Qux.objects.filter_attrs(weight__lt=10)))
+        self.assertEqual(
+            [self.quxs[1], self.quxs[0]],
+            list(Qux.objects.filter_attrs(weight__gte=0).order_by_attr('weight')),
+        )
+        self.assertEqual(
+            {'color': 'blue', 'weight': 9},
+            Qux.objects.with_attr_values('color', 'weight').get(pk=self.quxs[1].pk).attr_values,
+        )
+        self.assertEqual(
+            [{'color': 'red', 'weight': 10}, {'color': 'blue', 'weight': 9}, {'color': 'red', 'weight': None}],
+            [bag.as_dict() for bag in Qux.objects.attr_bags()],
+        )
+        self.assertEqual(
+            [(qux.pk, bag.as_dict()) for qux, bag in zip(self.quxs, Qux.objects.attr_bags())],
+            list(stream(Qux, chunk_size=2)),
+        )
+
+    def test_form(self):
+        """
+        Test forms on split storage
+        """
+        class QuxForm(ModelFormWithAttrs):
+            class Meta:
+                model = Qux
+                fields = ['name']
+
+        form = QuxForm(instance=self.quxs[0])
+        self.assertEqual('red', form.fields[FIELD_PREFIX + '{}'.format(self.color.pk)].initial)
+        self.assertEqual('10', form.fields[FIELD_PREFIX + '{}'.format(self.weight.pk)].initial)
+
+
+class FacetsTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_INTEGER)
+        self.red = mommy.make(Choice, attribute=self.color, value='R', name='red', sort_order=1)
+        self.blue = mommy.make(Choice, attribute=self.color, value='B', name='blue', sort_order=0)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.available = mommy.make(Attribute, slug='available', type=Attribute.TYPE_BOOLEAN)
+        for name, color, weight, available in (
+            ('a', self.red.pk, '5', 'yes'),
+            ('b', self.red.pk, '50', 'TRUE'),
+            ('c', self.blue.pk, '500', 'no'),
+            ('d', 'B', 'heavy', ''),
+        ):
+            foo = Foo.objects.create(name=name)
+            save_attribute_values(foo, {self.color.pk: color, self.weight.pk: weight, self.available.pk: available})
+
+    def test_facets(self):
+        """
+        Test counting attribute values in a single query
+        """
+        metadata.get_index()
+        with self.assertNumQueries(1):
+            result = facets(Foo.objects.all(), ['color', 'weight', 'available'], buckets={'weight': [10, 100]})
+        self.assertEqual(['color', 'weight', 'available'], list(result))
+        self.assertEqual([(self.blue.pk, 'blue', 2), (self.red.pk, 'red', 2)], result['color'])
+        self.assertEqual(
+            [((None, 10), '< 10', 1), ((10, 100), '10 - 100', 1), ((100, None), '>= 100', 1)],
+            result['weight'],
+        )
+        self.assertEqual([(True, 'yes', 2), (False, 'no', 1)], result['available'])
+        result = facets(Foo.objects.filter(name__in=['a', 'c']), ['weight'])
+        self.assertEqual([(5, '5', 1), (500, '500', 1)], result['weight'])
+        result = facets(Foo.objects.order_by('name')[:2], ['weight'])
+        self.assertEqual([(5, '5', 1), (50, '50', 1)], result['weight'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_cached_facets(self):
+        """
+        Test caching facets by queryset
+        """
+        metadata.get_index()
+        queryset = Foo.objects.filter(name='a')
+        result = facets(queryset, ['weight'], cache_timeout=60)
+        with self.assertNumQueries(0):
+            self.assertEqual(result, facets(queryset, ['weight'], cache_timeout=60))
+        with self.assertNumQueries(1):
+            facets(Foo.objects.filter(name='b'), ['weight'], cache_timeout=60)
+
+
+class AttrMappingTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.foos = [Foo.objects.create(name=name) for name in ('a', 'b')]
+        for foo, weight in zip(self.foos, ('10', 'heavy')):
+            save_attribute_values(foo, {self.color.pk: 'red', self.weight.pk: weight})
+
+    def test_get(self):
+        """
+        Test that obj.mav loads the attributes once and converts them on access
+        """
+        metadata.get_index()
+        foo = Foo.objects.get(pk=self.foos[0].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(10, foo.mav['weight'])
+        with self.assertNumQueries(0):
+            self.assertEqual('red', foo.mav['color'])
+            self.assertEqual('10', foo.mav.get_text('weight'))
+            self.assertEqual({'color': 'red', 'weight': 10}, dict(foo.mav))
+        self.assertIsNone(Foo.objects.get(pk=self.foos[1].pk).mav['weight'])
+        self.assertRaises(KeyError, lambda: foo.mav['unknown'])
+
+    def test_set_and_save(self):
+        """
+        Test that changes are tracked until they are saved in one batch
+        """
+        foo = self.foos[0]
+        foo.mav['weight'] = 12
+        foo.mav['color'] = 'red'
+        del foo.mav['color']
+        self.assertRaises(ValueError, foo.mav.__setitem__, 'weight', 'heavy')
+        self.assertEqual({'color', 'weight'}, foo.mav.get_dirty())
+        self.assertEqual(12, foo.mav['weight'])
+        self.assertNotIn('color', foo.mav)
+        # Nothing is written until save
+        self.assertEqual(2, foo.attrs.count())
+        foo.mav.save()
+        self.assertFalse(foo.mav.is_dirty)
+        self.assertEqual([(self.weight.pk, '12')], list(foo.attrs.values_list('attribute_id', 'value')))
+        # Saving the object saves the changes too
+        foo.mav['color'] = 'blue'
+        foo.save()
+        self.assertEqual({'color': 'blue', 'weight': 12}, dict(Foo.objects.get(pk=foo.pk).mav))
+
+    def test_with_mav(self):
+        """
+        Test priming the mappings of many objects with prefetched attributes
+        """
+        metadata.get_index()
+        with self.assertNumQueries(2):
+            foos = list(Foo.objects.with_mav().order_by('name'))
+            self.assertEqual([10, None], [foo.mav['weight'] for foo in foos])
+
+    def test_split_storage(self):
+        """
+        Test obj.mav with split storage
+        """
+        qux = Qux.objects.create(name='a')
+        qux.mav['weight'] = 10
+        qux.mav['color'] = 'red'
+        qux.save()
+        self.assertEqual({'color': 'red', 'weight': 10}, dict(Qux.objects.with_mav().get(pk=qux.pk).mav))
+        QuxAttrInteger = Qux._mav_classes_by_type[Attribute.TYPE_INTEGER]
+        self.assertEqual([10], [attr.value_int for attr in QuxAttrInteger.objects.all()])
+        del qux.mav['weight']
+        qux.mav.save()
+        self.assertFalse(QuxAttrInteger.objects.exists())
+        self.assertEqual({'color': 'red'}, dict(Qux.objects.get(pk=qux.pk).mav))
+
+
+class ReadOtherRouter(object):
+    """
+    Router that reads everything from the other database, like a replica that lags behind
+    """
+
+    def db_for_read(self, model, **hints):
+        return 'other'
+
+
+class MultiDatabaseTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        metadata.clear()
+        self.weight = mommy.make(Attribute, slug='weight', type=Attribute.TYPE_INTEGER)
+        self.weight.save(using='other')
+
+    def test_database_of_object(self):
+        """
+        Test that attribute values are read and written on the database of the object
+        """
+        foo = Foo.objects.using('other').create(name='a')
+        save_attribute_values(foo, {self.weight.pk: '10'})
+        self.assertFalse(Foo._mav_class.objects.exists())
+        foo = Foo.objects.using('other').get(pk=foo.pk)
+        self.assertEqual(10, foo.mav['weight'])
+        foo.mav['weight'] = 11
+        foo.save()
+        self.assertEqual(['11'], list(Foo._mav_class.objects.using('other').values_list('value', flat=True)))
+        self.assertEqual([foo], list(Foo.objects.using('other').filter_attrs(weight=11)))
+        self.assertEqual([{'weight': 11}], [bag.as_dict() for bag in Foo.objects.using('other').attr_bags()])
+        self.assertEqual({'weight': [(11, '11', 1)]}, dict(facets(Foo.objects.using('other'), ['weight'])))
+        baz = Baz.objects.using('other').create(name='b')
+        save_attribute_values(baz, {self.weight.pk: '12'})
+        self.assertEqual({'weight': 12}, get_attr_snapshot(Baz.objects.using('other').get(pk=baz.pk)))
+        self.assertFalse(Baz._mav_class.snapshot_class.objects.exists())
+
+    @override_settings(DATABASE_ROUTERS=['mav.tests.ReadOtherRouter'])
+    def test_metadata_database(self):
+        """
+        Test that the metadata is loaded from the database for writing, not from a replica
+        """
+        color = mommy.make(Attribute, slug='color', type=Attribute.TYPE_TEXT)
+        attribute_set = AttributeSet.objects.create(slug='shirts', name='Shirts')
+        AttributeSetMembership.objects.create(attribute_set=attribute_set, attribute=color)
+        metadata.clear()
+        self.assertEqual(color, metadata.get_attribute_by_slug('color'))
+        self.assertEqual(['color'], metadata.get_schema(attribute_set.pk).slugs)
+
+    @override_settings(MAV_REPLICA_DATABASES=['other'])
+    def test_replica_router_in_transaction(self):
+        """
+        Test that the replica router reads from the primary inside a transaction
+        """
+        self.assertEqual('default', ReplicaRouter().db_for_read(Attribute))
+
+
+@override_settings(MAV_REPLICA_DATABASES=['other'])
+class ReplicaRouterTestCase(SimpleTestCase):
+    def test_router(self):
+        """
+        Test that the replica router sends reads of mav models to replicas and writes to the primary
+        """
+        router = ReplicaRouter()
+        self.assertEqual('other', router.db_for_read(Attribute))
+        self.assertEqual('other', router.db_for_read(Foo._mav_class))
+        self.assertEqual('default', router.db_for_write(Foo._mav_class))
+        self.assertIsNone(router.db_for_read(Foo))
+        self.assertIsNone(router.db_for_write(User))
+        foo = Foo(pk=1)
+        foo._state.db = 'default'
+        attr = Foo._mav_class(object_id=1)
+        attr._state.db = 'other'
+        self.assertTrue(router.allow_relation(attr, foo))
+        self.assertIsNone(router.allow_relation(foo, User()))
+        self.assertFalse(router.allow_migrate('other', 'mav', model_name='attribute', model=Attribute))
+        self.assertIsNone(router.allow_migrate('default', 'mav', model_name='attribute', model=Attribute))
+
+
+class RegistryTestCase(TestCase):
+    def test_registry(self):
+        """
+        Test looking up the models with mav and their attr classes
+        """
+        self.assertEqual([Foo, Bar, Baz, Qux], registry.get_mav_models())
+        self.assertIs(Foo._mav_class, registry.get_attr_class(Foo))
+        self.assertIs(Qux._mav_classes_by_type[Attribute.TYPE_TEXT], registry.get_attr_class(Qux))
+        self.assertRaises(LookupError, registry.get_attr_class, User)
+        self.assertFalse(registry.is_registered(User))
+
+
+class FooAdmin(MavAdminMixin, admin.ModelAdmin):
+    list_display = ['name']
+    mav_list_display = ['color', 'available']
+    mav_list_filter = ['color']
+
+
+class AdminTestCase(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.color = mommy.make(Attribute, slug='color', name='color', type=Attribute.TYPE_TEXT)
+        self.red = mommy.make(Choice, attribute=self.color, value='R', name='red')
+        self.blue = mommy.make(Choice, attribute=self.color, value='B', name='blue')
+        self.available = mommy.make(Attribute, slug='available', name='available', type=Attribute.TYPE_BOOLEAN)
+        self.foos = [Foo.objects.create(name='foo {}'.format(i)) for i in range(10)]
+        for i, foo in enumerate(self.foos):
+            save_attribute_values(foo, {
+                self.color.pk: self.red.pk if i % 2 else self.blue.pk,
+                self.available.pk: 'yes' if i % 2 else '',
+            })
+        self.model_admin = FooAdmin(Foo, admin.AdminSite())
+        self.request = RequestFactory().get('/')
+        self.request.user = mommy.make(User, is_superuser=True)
+
+    def test_list_display(self):
+        """
+        Test that the attribute columns are filled from the changelist query
+        """
+        metadata.get_index()
+        list_display = self.model_admin.get_list_display(self.request)
+        self.assertEqual(['name', 'mav_color', 'mav_available'], [
+            column if isinstance(column, six.string_types) else column.__name__ for column in list_display
+        ])
+        self.assertEqual('color', list_display[1].short_description)
+        self.assertFalse(self.model_admin.get_queryset(self.request).query.annotations)
+        request = RequestFactory().get('/', {'o': '-0'})
+        request.user = self.request.user
+        with CaptureQueriesContext(connection) as context:
+            changelist = self.get_changelist(request)
+        # Counting the objects does not select the attribute values
+        self.assertNotIn('mav_foo_attr', ' '.join(query['sql'] for query in context.captured_queries))
+        with self.assertNumQueries(1):
+            rows = [[list_display[1](foo), list_display[2](foo)] for foo in changelist.result_list]
+        self.assertEqual([['red', True], ['blue', None]], rows[:2])
+
+    def get_changelist(self, request):
+        list_display = self.model_admin.get_list_display(request)
+        return self.model_admin.get_changelist(request)(
+            request, Foo, list_display, self.model_admin.get_list_display_links(request, list_display),
+            self.model_admin.get_list_filter(request), self.model_admin.date_hierarchy,
+            self.model_admin.get_search_fields(request), self.model_admin.get_list_select_related(request),
+            self.model_admin.list_per_page, self.model_admin.list_max_show_all, self.model_admin.list_editable,
+            self.model_admin,
+        )
+
+    def test_order_by_column(self):
+        """
+        Test that attribute columns order by the typed value
+        """
+        weight = mommy.make(Attribute, slug='weight', name='weight', type=Attribute.TYPE_INTEGER)
+        weights = [5, 20, 0, 15, 10, 100, 3, 7, 1, 50]
+        for foo, value in zip(self.foos, weights):
+            save_attribute_values(foo, {weight.pk: value})
+        self.model_admin.mav_list_display = ['weight']
+        request = RequestFactory().get('/', {'o': '1'})
+        request.user = self.request.user
+        changelist = self.get_changelist(request)
+        self.assertEqual(sorted(weights), [foo.attr_values['weight'] for foo in changelist.result_list])
+
+    def test_list_filter(self):
+        """
+        Test the list filter on the choices of an attribute
+        """
+        list_filter = self.model_admin.get_list_filter(self.request)[0]
+        list_filter = list_filter(self.request, {'mav_color': '{}'.format(self.red.pk)}, Foo, self.model_admin)
+        self.assertEqual('color', list_filter.title)
+        self.assertEqual(
+            sorted(['{}'.format(self.red.pk), '{}'.format(self.blue.pk)]),
+            sorted(value for value, label in list_filter.lookup_choices),
+        )
+        self.assertEqual(self.foos[1::2], list(list_filter.queryset(self.request, Foo.objects.order_by('pk'))))
+        mommy.make(Attribute, slug='weight', name='weight', type=Attribute.TYPE_INTEGER)
+        list_filter = attribute_list_filter('weight')(self.request, {'mav_weight': 'heavy'}, Foo, self.model_admin)
+        with self.assertRaises(IncorrectLookupParameters):
+            list_filter.queryset(self.request, Foo.objects.all())
+
+    def test_inline(self):
+        """
+        Test that the attrs inline gets its attribute choices from the metadata
+        """
+        metadata.get_index()
+        inline = self.model_admin.get_inline_instances(self.request, self.foos[0])[0]
+        self.assertEqual(Foo._mav_class, inline.model)
+        formset_class = inline.get_formset(self.request, self.foos[0])
+        with self.assertNumQueries(1):
+            formset = formset_class(instance=self.foos[0])
+            choices = [list(form.fields['attribute'].choices) for form in formset.forms]
+        self.assertEqual(3, len(choices))
+        self.assertEqual([self.available.pk, self.color.pk], [pk for pk, label in choices[0][1:]])
+        data = {
+            'attrs-TOTAL_FORMS': '1',
+            'attrs-INITIAL_FORMS': '0',
+            'attrs-0-attribute': '{}'.format(self.color.pk),
+            'attrs-0-value': '{}'.format(self.red.pk),
+        }
+        Foo._mav_class.objects.filter(object=self.foos[0]).delete()
+        formset = formset_class(data, instance=self.foos[0])
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(['{}'.format(self.red.pk)], [attr.value for attr in self.foos[0].attrs.all()])
+
+    def test_inline_validation(self):
+        """
+        Test that the attrs inline validates and normalizes values by the type of their attribute
+        """
+        weight = mommy.make(Attribute, slug='weight', name='weight', type=Attribute.TYPE_DECIMAL)
+        metadata.get_index()
+        inline = self.model_admin.get_inline_instances(self.request, self.foos[0])[0]
+        formset_class = inline.get_formset(self.request, self.foos[0])
+        Foo._mav_class.objects.filter(object=self.foos[0]).delete()
+        for attribute, text, expected in [
+            (self.color, 'green', None),
+            (self.available, 'maybe', None),
+            (weight, 'heavy', None),
+            (weight, '1.50', '1.5'),
+            (self.available, 'yes', 'yes'),
+        ]:
+            formset = formset_class({
+                'attrs-TOTAL_FORMS': '1',
+                'attrs-INITIAL_FORMS': '0',
+                'attrs-0-attribute': '{}'.format(attribute.pk),
+                'attrs-0-value': text,
+            }, instance=self.foos[0])
+            self.assertEqual(expected is not None, formset.is_valid(), text)
+            if expected is not None:
+                self.assertEqual(expected, formset.save()[0].value)
+            else:
+                self.assertIn('value', formset.errors[0])
+
+    def test_inline_permissions(self):
+        """
+        Test that the permissions for the attrs inline are those of the attr class
+        """
+        user = mommy.make(User, is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='change_foo'))
+        self.request.user = user
+        self.assertEqual([], self.model_admin.get_inline_instances(self.request, self.foos[0]))
+        user = User.objects.get(pk=user.pk)
+        user.user_permissions.add(*Permission.objects.filter(codename__in=['add_fooattr', 'change_fooattr']))
+        self.request.user = user
+        inline = self.model_admin.get_inline_instances(self.request, self.foos[0])[0]
+        self.assertTrue(inline.has_add_permission(self.request))
+        self.assertTrue(inline.has_change_permission(self.request, self.foos[0]))
+        self.assertFalse(inline.has_delete_permission(self.request, self.foos[0]))
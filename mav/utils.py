@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
+from django.apps import apps
 from django.utils.text import slugify
 
+from . import registry
+
 
 def slugify_with_underscores(text):
     """
@@ -12,3 +15,13 @@ def slugify_with_underscores(text):
     return slugify(text).replace('-', '_')
 
 
+def get_mav_model(label):
+    """
+    Get a model with mav by its label
+    :param label: The label of the model (app_label.ModelName)
+    :return: The model class
+    """
+    model = apps.get_model(label)
+    if not registry.is_registered(model):
+        raise LookupError('Model {label} does not have mav.'.format(label=label))
+    return model
@@ -46,7 +46,7 @@ setup(
     ],
     include_package_data=True,
     install_requires=[
-        "Django > 1.4",
+        "Django >= 1.11, < 2.0",
     ],
     license="MIT License",
     zip_safe=False,
@@ -56,10 +56,11 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
         'Operating System :: OS Independent',
         'Topic :: Software Development :: Libraries',
         'Topic :: Utilities',